@@ -3,95 +3,160 @@ import dash
 import dash_core_components as dcc
 import dash_html_components as html
 
-from utils import queries
-from dash.dependencies import Input, Output
-import plotly.graph_objects as go
+from utils import catalog, jobs, metrics
+from dash.dependencies import ClientsideFunction, Input, Output, State
+import flask
+import json
 import time
 import datetime
 
+# The query layer (pandas, SQLAlchemy) and plotly are imported by the callbacks that need them, so workers start
+# without paying for them or touching the database.
+
 # Starting dash!
 app = dash.Dash(__name__)
 application = app.server
 app.title = 'São Paulo Bus System Analysis'
 
-# Getting data frame of all São Paulo bus routes
-routes = queries.get_routes()
-
-# Transforming data frame into list with dictionaries.
-routes_data = routes[['route_id', 'route_long_name']].apply(lambda x: {'label': x['route_long_name'],
-                                                                       'value': x['route_id']}, axis=1).to_list()
-# App layout
-app.layout = html.Div(children=[ # Master div
-    html.Div([ # Dropdown container
-        dcc.Dropdown( # Bus route dropdown
-            id='dropdown-route',
-            options=routes_data,
-            placeholder='Select a bus route',
-            value='',
-            className='dropdown'
-        ),
-        html.Br(),
-        dcc.Dropdown( # First stop dropdown
-            id='dropdown-stop-first',
-            options=[],
-            placeholder='Select the first stop',
-            className='dropdown'
-        ),
-        html.Br(),
-        dcc.Dropdown( # Second stop dropdown
-            id='dropdown-stop-second',
-            options=[],
-            placeholder='Select the second stop',
-            className='dropdown'
-        ),
-        dcc.Dropdown( # Hour of the day
-            id='dropdown-hour',
-            options=[{'label': datetime.time(i).strftime('%I %p'), 'value': str(i).zfill(2) + ':' + '00'}
-                     for i in range(24)],
-            placeholder='Select hour',
-            className='dropdown'
-        )
-    ], className='dropdown-container'),
-    html.Div([ # Graphs and maps container
-        html.Div([ # Map
-            dcc.Graph(
-                id='map-graph'
-            )
-        ], className='map'),
-        html.Div([ # Passengers graph
-            dcc.Graph(
-                id='passengers-graph'
-            )
-        ], className='passengers'),
-        html.Div([ # Time graph
-            dcc.Graph(
-                id='time-graph'
+# Weekdays of the travel time heatmap, in the order of utils/crossings.py (not imported here, it needs pandas).
+WEEKDAYS = ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday']
+
+# Initial zoom of the map. Route lines are simplified to within a pixel two zoom levels further in (see map_tolerance).
+MAP_ZOOM = 12
+
+
+def map_tolerance():
+    """Returns the size in metres of a pixel two zoom levels past the initial zoom, in São Paulo."""
+
+    from utils import linref
+
+    return float(linref.pixel_size(MAP_ZOOM + 2, -23.5507))
+
+
+# Creating the derived tables, indexes and route mappings the queries rely on, if they are missing
+@application.before_first_request
+def prepare_database():
+    from utils import queries
+
+    try:
+        queries.prepare_database()
+    except Exception as error:
+        print('Could not prepare the database, using it as it is: ', error)
+
+
+def route_options():
+    """Options of the route dropdown, loaded on the first page request (see utils/catalog.py).
+
+    Dash also builds the layout when callbacks are registered, at import, where the options are left empty.
+    """
+
+    return catalog.route_options() if flask.has_request_context() else []
+
+
+# App layout, built for every page load so the routes can be loaded lazily and retried if the database was missing
+def serve_layout():
+    return html.Div(children=[ # Master div
+        html.Div([ # Dropdown container
+            dcc.Dropdown( # Bus route dropdown
+                id='dropdown-route',
+                options=route_options(),
+                placeholder='Select a bus route',
+                value='',
+                className='dropdown'
+            ),
+            html.Br(),
+            dcc.Dropdown( # First stop dropdown
+                id='dropdown-stop-first',
+                options=[],
+                placeholder='Select the first stop',
+                className='dropdown'
+            ),
+            html.Br(),
+            dcc.Dropdown( # Second stop dropdown
+                id='dropdown-stop-second',
+                options=[],
+                placeholder='Select the second stop',
+                className='dropdown'
+            ),
+            dcc.Dropdown( # Hour of the day
+                id='dropdown-hour',
+                options=[{'label': datetime.time(i).strftime('%I %p'), 'value': str(i).zfill(2) + ':' + '00'}
+                         for i in range(24)],
+                placeholder='Select hour',
+                className='dropdown'
             )
-        ], className='time')
-    ], className='analysis'),
-    html.Div(className='clearfix'),
+        ], className='dropdown-container'),
+        html.Div([ # Graphs and maps container
+            html.Div([ # Map
+                dcc.Graph(
+                    id='map-graph'
+                ),
+                dcc.Store(id='map-base'), # Map of the route, before the chosen stops are highlighted
+                dcc.Store(id='route-stops') # Stops of the route, for the stop dropdowns
+            ], className='map'),
+            html.Div([ # Passengers graph
+                dcc.Graph(
+                    id='passengers-graph'
+                )
+            ], className='passengers'),
+            html.Div([ # Time graph
+                dcc.Graph(
+                    id='time-graph'
+                ),
+                html.P(id='time-status', className='time-status'), # Progress of the travel time computation
+                dcc.Store(id='time-job'), # Id of the travel time job the page is waiting for
+                dcc.Interval(id='time-interval', interval=500, disabled=True) # Polls the job while it runs
+            ], className='time'),
+            html.Div(className='clearfix'),
+            html.Div([ # Travel time between every pair of stops
+                dcc.Dropdown( # Weekday of the heatmap
+                    id='dropdown-weekday',
+                    options=[{'label': day, 'value': day} for day in WEEKDAYS],
+                    value='Monday',
+                    clearable=False,
+                    className='dropdown'
+                ),
+                html.Button( # The matrix reads the route's whole history, so it is only computed on demand
+                    'Show the travel times between all stops',
+                    id='matrix-button',
+                    className='matrix-button'
+                ),
+                dcc.Graph(
+                    id='matrix-graph'
+                ),
+                html.P(id='matrix-status', className='time-status'), # Progress of the matrix computation
+                dcc.Store(id='matrix-job'), # Id of the travel time matrix job the page is waiting for
+                dcc.Interval(id='matrix-interval', interval=500, disabled=True) # Polls the job while it runs
+            ], className='matrix')
+        ], className='analysis'),
+        html.Div(className='clearfix'),
+
+        html.P(id='time'),
 
-    html.P(id='time'),
+        html.Div(children=[ # Footer
+                html.Div(children=[
+                    html.P(children='Team 21 - São Paulo Bus Transit Times', className='footer-text'),
 
-    html.Div(children=[ # Footer
-            html.Div(children=[
-                html.P(children='Team 21 - São Paulo Bus Transit Times', className='footer-text'),
+                    html.P(children='''
+                        Project by João Pedro Barreto, Rafael Alves de Souza, and Henrique Novak
+                    ''', className='footer-text')], className='footer')], className='footer-container')
+    ])
 
-                html.P(children='''
-                    Project by João Pedro Barreto, Rafael Alves de Souza, and Henrique Novak
-                ''', className='footer-text')], className='footer')], className='footer-container')
-])
+
+app.layout = serve_layout
 
 
 # Function input is the chosen route from the dropdown button
 @app.callback(
-    Output('map-graph', 'figure'),
+    Output('map-base', 'data'),
     [Input('dropdown-route', 'value')]
 )
+@metrics.timed('callback')
 def update_map(route):
-    """Updates São Paulo's map when a route is chosen."""
+    """Updates São Paulo's map when a route is chosen. The chosen stops are highlighted on it in the browser."""
 
-    now = time.time()
+    from utils import queries
+    import plotly.graph_objects as go
 
     # If there is no route chosen, display empty map centered in São Paulo
     if not route:
@@ -102,9 +167,10 @@ def update_map(route):
         # Get all stops from that route
         stops = queries.get_stops(route)
 
-        # Check if we have the stops for that route
+        # Check if we have the stops for that route. Stops served in both directions get a single marker, and
+        # coordinates are rounded to about a metre.
         if not stops.empty:
-            bus_stops = stops
+            bus_stops = stops.drop_duplicates('stop_id').round({'stop_lat': 5, 'stop_lon': 5})
 
         # If we don't have, display empty map
         else:
@@ -124,23 +190,20 @@ def update_map(route):
     # If a route is chosen
     if route and route is not None:
 
-        # Get the shape of the route
-        shape = queries.get_shape(route)
+        # Get the simplified lines of the route's distinct shapes
+        shape = queries.get_map_shape(route, map_tolerance())
 
         # Check if we have the shape for that route
-        if not shape.empty:
-            color = '#' + shape['color'].iloc[0]
+        if shape['lat']:
 
-            # Create line shape
+            # Create line shape, one trace for every shape of the route
             fig.add_trace(go.Scattermapbox(
-                lat=shape['shape_pt_lat'].to_list(),
-                lon=shape['shape_pt_lon'].to_list(),
+                lat=shape['lat'],
+                lon=shape['lon'],
                 mode='lines',
-                marker=go.scattermapbox.Marker(
-                    color=color,
-                    opacity=0.7
-                ),
-                text=shape['route_id'].iloc[0],
+                line=go.scattermapbox.Line(color='#' + shape['color'], width=3),
+                opacity=0.7,
+                text=route,
                 hoverinfo='text',
                 name='Route'
             ))
@@ -156,12 +219,10 @@ def update_map(route):
                 lon=list(bus_stops['stop_lon'])[0]
             ),
             pitch=0,
-            zoom=12
+            zoom=MAP_ZOOM
         )
     )
 
-    print('Time of execution: ', time.time() - now)
-
     return fig
 
 
@@ -170,8 +231,12 @@ def update_map(route):
     Output('passengers-graph', 'figure'),
     [Input('dropdown-route', 'value')]
 )
+@metrics.timed('callback')
 def update_passengers(route):
 
+    from utils import queries
+    import plotly.graph_objects as go
+
     # If there is a route chosen
     if route:
 
@@ -187,62 +252,246 @@ def update_passengers(route):
     return fig
 
 
-# Function input is the first-stop dropdown
+# Function input is the chosen route from the dropdown button
 @app.callback(
-    Output('dropdown-stop-first', 'options'),
+    Output('route-stops', 'data'),
     [Input('dropdown-route', 'value')]
 )
-def update_first_stop(route):
+@metrics.timed('callback')
+def update_route_stops(route):
+    """Sends the route's stops to the browser, where the stop dropdowns and the map highlight are built."""
+
+    from utils import queries
+
     if route is None or not route:
-        return []
+        return None
 
-    stops = queries.get_stops(route)
-    stop_data = []
+    stops = queries.get_stops(route).round({'stop_lat': 5, 'stop_lon': 5})
 
-    for i in range(len(stops)):
-        row = stops.iloc[i]
-        stop_data.append({'label': row['stop_name'], 'value': row['stop_id']})
-    return stop_data
+    return {column: stops[column].tolist() for column in ['stop_id', 'stop_name', 'stop_lat', 'stop_lon',
+                                                          'stop_sequence', 'direction_id']}
 
 
-# Function input is the second-stop dropdown
-@app.callback(
-    Output('dropdown-stop-second', 'options'),
-    [Input('dropdown-route', 'value')]
+# Stop dropdowns and the map highlight are derived in the browser from the route's stops (assets/stops.js)
+app.clientside_callback(
+    ClientsideFunction(namespace='stops', function_name='firstOptions'),
+    Output('dropdown-stop-first', 'options'),
+    [Input('route-stops', 'data')]
 )
-def update_second_stop(route):
-    if route is None or not route:
-        return []
 
-    stops = queries.get_stops(route)
-    stop_data = []
+app.clientside_callback(
+    ClientsideFunction(namespace='stops', function_name='secondOptions'),
+    Output('dropdown-stop-second', 'options'),
+    [Input('route-stops', 'data'), Input('dropdown-stop-first', 'value')]
+)
 
-    for i in range(len(stops)):
-        row = stops.iloc[i]
-        stop_data.append({'label': row['stop_name'], 'value': row['stop_id']})
-    return stop_data
+app.clientside_callback(
+    ClientsideFunction(namespace='stops', function_name='highlightMap'),
+    Output('map-graph', 'figure'),
+    [Input('map-base', 'data'), Input('route-stops', 'data'), Input('dropdown-stop-first', 'value'),
+     Input('dropdown-stop-second', 'value')]
+)
 
 
 # Function input is the first-stop, second-stop dropdown, and route
 @app.callback(
-    Output('time-graph', 'figure'),
+    Output('time-job', 'data'),
     [Input('dropdown-route', 'value'), Input('dropdown-stop-first', 'value'), Input('dropdown-stop-second', 'value'),
-     Input('dropdown-hour', 'value')]
+     Input('dropdown-hour', 'value')],
+    [State('time-job', 'data')]
 )
-def calc_time(route, first_stop, second_stop, hour):
+@metrics.timed('callback')
+def calc_time(route, first_stop, second_stop, hour, previous_job):
+    """Queues the travel time computation and returns right away. The result is polled by update_time."""
 
-    if route is not None and first_stop is not None and second_stop is not None and hour is not None:
-        fig = queries.historial_timedelta(route, first_stop, second_stop, hour)
-        print('Uhul! Got the graph!')
+    from utils import queries
 
-    else:
+    # The previous selection is superseded: its job is cancelled unless another page is waiting for it too.
+    if previous_job:
+        jobs.queue.release(previous_job['id'])
+
+    if route and first_stop is not None and second_stop is not None and hour is not None:
+        args = [route, first_stop, second_stop, hour]
+        return {'id': jobs.queue.submit(queries.travel_time_data, *args), 'args': args}
+
+    return None
+
+
+# Function input is the travel time job and the polling interval
+@app.callback(
+    [Output('time-graph', 'figure'), Output('time-status', 'children'), Output('time-interval', 'disabled')],
+    [Input('time-job', 'data'), Input('time-interval', 'n_intervals')]
+)
+@metrics.timed('callback')
+def update_time(job, n_intervals):
 
+    from utils import queries
+    import plotly.graph_objects as go
+
+    if not job:
         fig = go.Figure()
 
+    else:
+        status = jobs.queue.status(job['id'])
+
+        # The job was queued by another web worker (or its result expired): run it here under the same id.
+        if status['state'] == 'unknown':
+            jobs.queue.submit(queries.travel_time_data, *job['args'])
+            status = jobs.queue.status(job['id'])
+
+        # Still computing: keep the current graph and poll again.
+        if status['state'] in ('queued', 'running'):
+            return dash.no_update, f'Computing travel times ({status["state"]}, {status["elapsed"]:.0f}s)...', False
+
+        if status['state'] == 'done':
+            fig = queries.travel_time_figure(*jobs.queue.result(job['id']))
+
+        else:
+            fig = go.Figure()
+            return fig, 'Could not compute the travel times for this selection.', True
+
     fig.update_layout(xaxis_title='Weekday', yaxis_title=f'Time between stops', title=dict(x=0.5, font={'size': 15}))
 
-    print('Sending graph!')
-    return fig
+    return fig, '', True
+
+
+# Function input is the chosen route from the dropdown button and the matrix button
+@app.callback(
+    Output('matrix-job', 'data'),
+    [Input('dropdown-route', 'value'), Input('matrix-button', 'n_clicks')],
+    [State('matrix-job', 'data')]
+)
+@metrics.timed('callback')
+def calc_matrix(route, n_clicks, previous_job):
+    """Queues the travel time matrix of the route when the button is clicked. Choosing another route drops it. The
+    weekday and hour only pick a slice of it (update_matrix)."""
+
+    from utils import queries
+
+    clicked = any(trigger['prop_id'] == 'matrix-button.n_clicks' for trigger in dash.callback_context.triggered)
+
+    # Clicking again keeps waiting for the same matrix, unless it failed.
+    if (clicked and previous_job and previous_job['args'] == [route] and
+            jobs.queue.status(previous_job['id'])['state'] != 'failed'):
+        return dash.no_update
+
+    if previous_job:
+        jobs.queue.release(previous_job['id'])
+
+    if route and clicked:
+        args = [route]
+        return {'id': jobs.queue.submit(queries.travel_time_matrix, *args), 'args': args}
+
+    return None
+
+
+# Function input is the travel time matrix job, the polling interval, the weekday and the hour
+@app.callback(
+    [Output('matrix-graph', 'figure'), Output('matrix-status', 'children'), Output('matrix-interval', 'disabled')],
+    [Input('matrix-job', 'data'), Input('matrix-interval', 'n_intervals'), Input('dropdown-weekday', 'value'),
+     Input('dropdown-hour', 'value')]
+)
+@metrics.timed('callback')
+def update_matrix(job, n_intervals, weekday, hour):
+
+    from utils import queries
+    import plotly.graph_objects as go
+
+    if not job or hour is None:
+        return go.Figure(), '', True
+
+    status = jobs.queue.status(job['id'])
+
+    # Queued by another web worker, or its result expired: run it here under the same id.
+    if status['state'] == 'unknown':
+        jobs.queue.submit(queries.travel_time_matrix, *job['args'])
+        status = jobs.queue.status(job['id'])
+
+    if status['state'] in ('queued', 'running'):
+        return dash.no_update, f'Computing the travel time matrix ({status["state"]}, {status["elapsed"]:.0f}s)...', \
+            False
+
+    if status['state'] != 'done':
+        return go.Figure(), 'Could not compute the travel time matrix for this route.', True
+
+    fig = queries.travel_time_matrix_figure(*jobs.queue.result(job['id']), weekday, hour)
+    fig.update_layout(title=dict(x=0.5, font={'size': 15}))
+
+    return fig, '', True
+
+
+# Travel time percentiles between every pair of stops of a route, optionally for one direction, weekday and hour.
+# The matrix is computed in the job queue: until it is ready, the answer is 202 with the job's state, to ask again.
+@application.route('/api/routes/<route>/travel-times')
+def travel_times_api(route):
+    from utils import queries
+
+    id = jobs.queue.submit(queries.travel_time_matrix, route)
+    status = jobs.queue.status(id)
+
+    if status['state'] in ('queued', 'running'):
+        response = flask.jsonify(route=route, state=status['state'], elapsed=status['elapsed'])
+        response.status_code = 202
+        response.headers['Retry-After'] = '5'
+        return response
+
+    if status['state'] != 'done':
+        flask.abort(500, f'Could not compute the travel times of route {route}')
+
+    matrix, stops = jobs.queue.result(id)
+
+    for column, convert in [('direction_id', int), ('weekday', str), ('hour', str)]:
+        value = flask.request.args.get(column)
+        if value is not None:
+            try:
+                matrix = matrix[matrix[column] == convert(value)]
+            except ValueError:
+                flask.abort(400, f'Invalid {column}: {value}')
+
+    # Serialized by pandas, which turns its numpy values and NaN into JSON.
+    return flask.jsonify(route=route,
+                         stops=json.loads(stops[['direction_id', 'stop_sequence', 'stop_id', 'stop_name']]
+                                          .to_json(orient='records')),
+                         travel_times=json.loads(matrix.to_json(orient='records')))
+
+
+# Stops within a radius (metres, default 300) of a point, closest first
+@application.route('/api/stops/nearest')
+def nearest_stops_api():
+    from utils import queries
+
+    try:
+        lat = float(flask.request.args['lat'])
+        lon = float(flask.request.args['lon'])
+        radius = float(flask.request.args.get('radius', 300))
+    except (KeyError, ValueError):
+        flask.abort(400, 'lat and lon are required, and lat, lon and radius must be numbers')
+
+    stops = queries.nearest_stops(lat, lon, radius)
+
+    return flask.jsonify(stops=json.loads(stops.to_json(orient='records')))
+
+
+@application.before_request
+def start_request():
+    flask.g.request_start = time.perf_counter()
+
+
+# Records the duration and response size of every callback request, and the serialization of its output
+@application.after_request
+def finish_request(response):
+    if flask.request.path.endswith('_dash-update-component'):
+        output = (flask.request.get_json(silent=True) or {}).get('output', '')
+        size = 0 if response.direct_passthrough else len(response.get_data())
+        metrics.request_finished(output, time.perf_counter() - flask.g.request_start, size)
+
+    return response
+
+
+# Latency histograms and counters of this worker, in the Prometheus text format
+@application.route('/metrics')
+def metrics_page():
+    return flask.Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,89 @@
+// Clientside callbacks of the stop dropdowns and the map (see application.py). They read the stops of the chosen
+// route, sent once per route selection to the route-stops store as columns: stop_id, stop_name, stop_lat, stop_lon,
+// stop_sequence and direction_id, one row per stop and direction in route order.
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    stops: {
+        // Every stop of the route once, in route order.
+        firstOptions: function(stops) {
+            if (!stops) {
+                return [];
+            }
+
+            var seen = {};
+            var options = [];
+            for (var i = 0; i < stops.stop_id.length; i++) {
+                if (!seen[stops.stop_id[i]]) {
+                    seen[stops.stop_id[i]] = true;
+                    options.push({label: stops.stop_name[i], value: stops.stop_id[i]});
+                }
+            }
+
+            return options;
+        },
+
+        // The stops served after the first stop, in any direction serving it. Every stop while none is chosen.
+        secondOptions: function(stops, first) {
+            if (!stops) {
+                return [];
+            }
+            if (first === null || first === undefined) {
+                return window.dash_clientside.stops.firstOptions(stops);
+            }
+
+            // Position of the first stop in each direction that serves it.
+            var start = {};
+            for (var i = 0; i < stops.stop_id.length; i++) {
+                var direction = stops.direction_id[i];
+                if (stops.stop_id[i] === first && !(direction in start && start[direction] <= stops.stop_sequence[i])) {
+                    start[direction] = stops.stop_sequence[i];
+                }
+            }
+
+            var seen = {};
+            var options = [];
+            for (var j = 0; j < stops.stop_id.length; j++) {
+                var id = stops.stop_id[j];
+                if (stops.direction_id[j] in start && stops.stop_sequence[j] > start[stops.direction_id[j]] &&
+                        id !== first && !seen[id]) {
+                    seen[id] = true;
+                    options.push({label: stops.stop_name[j], value: id});
+                }
+            }
+
+            return options;
+        },
+
+        // The route map sent by the server, with the chosen stops highlighted.
+        highlightMap: function(base, stops, first, second) {
+            if (!base) {
+                return {data: [], layout: {}};
+            }
+
+            var lat = [];
+            var lon = [];
+            var text = [];
+            if (stops) {
+                [first, second].forEach(function(chosen) {
+                    var i = stops.stop_id.indexOf(chosen);
+                    if (chosen !== null && chosen !== undefined && i >= 0) {
+                        lat.push(stops.stop_lat[i]);
+                        lon.push(stops.stop_lon[i]);
+                        text.push(stops.stop_name[i]);
+                    }
+                });
+            }
+
+            if (!lat.length) {
+                return base;
+            }
+
+            return {
+                data: base.data.concat([{
+                    type: 'scattermapbox', lat: lat, lon: lon, text: text, mode: 'markers', hoverinfo: 'text',
+                    marker: {size: 14, color: '#D62728'}, name: 'Selected stops'
+                }]),
+                layout: base.layout
+            };
+        }
+    }
+});
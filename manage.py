@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""Offline maintenance commands for the bus database.
+
+Usage:
+    python manage.py schema [--rebuild]
+    python manage.py segments [--route ROUTE ...] [--workers N]
+    python manage.py export-positions [--route ROUTE ...] [--path PATH]
+    python manage.py ingest FILE [FILE ...] [--batch-size N]
+    python manage.py passengers
+    python manage.py generate [--routes N] [--vehicles N] [--days N] [--seed N]
+    python manage.py benchmark [--routes N] [--repeat N] [--warm] [--no-callbacks] [--output PATH] [--compare PATH]
+"""
+import argparse
+import os
+import sys
+
+from utils import benchmark, db, ingest, passengers, position_store, schema, segments, synthetic
+from utils.cache import cache
+
+
+def prepare_schema(connection, args):
+    schema.create_tables(connection)
+    schema.create_indexes(connection)
+    schema.build_route_maps(connection, rebuild=args.rebuild)
+
+
+def build_segments(connection, args):
+    segments.build_segment_times(connection, args.route or None, args.workers)
+
+
+def export_positions(connection, args):
+    position_store.export_positions(connection, args.route or None, args.path)
+
+
+def ingest_positions(connection, args):
+    ingest.ingest_files(connection, args.file, args.batch_size)
+
+
+def refresh_passengers(connection, args):
+    if passengers.refresh_passenger_stats(connection):
+        cache.invalidate('passengers:')
+
+
+def generate_database(connection, args):
+    synthetic.generate(connection, args.routes, args.vehicles, args.days, seed=args.seed)
+
+
+def run_benchmark(connection, args):
+    report = benchmark.run(args.routes, args.repeat, args.warm, not args.no_callbacks)
+
+    output = args.output or os.path.join('benchmarks', report['date'].replace(':', '') + '.json')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    benchmark.save(report, output)
+    print(f'Saved to {output}')
+
+    if args.compare and benchmark.compare(benchmark.load(args.compare), report):
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Maintenance commands for the bus database.')
+    parser.add_argument('--database', help='Path to a SQLite bus database to use instead of BUS_APP_DATABASE_URL.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    # Creates the derived tables, indexes, route mappings and route stops
+    schema_parser = commands.add_parser('schema', help='Create derived tables, indexes and route mappings.')
+    schema_parser.add_argument('--rebuild', action='store_true', help='Rebuild the route mappings and route stops from scratch.')
+    schema_parser.set_defaults(handler=prepare_schema)
+
+    # Precomputes the travel time between consecutive stops of each route
+    segments_parser = commands.add_parser('segments', help='Build the segment_times table.')
+    segments_parser.add_argument('--route', action='append', help='Only rebuild this route. Can be repeated.')
+    segments_parser.add_argument('--workers', type=int, help='Processes to split each route across, by vehicle '
+                                                             '(default BUS_APP_COMPUTE_WORKERS).')
+    segments_parser.set_defaults(handler=build_segments)
+
+    # Copies bus_position into the columnar store read by the travel time pipeline
+    export_parser = commands.add_parser('export-positions', help='Export bus_position to the columnar store.')
+    export_parser.add_argument('--route', action='append', help='Only export this route. Can be repeated.')
+    export_parser.add_argument('--path', help='Store directory instead of BUS_APP_POSITIONS_PATH.')
+    export_parser.set_defaults(handler=export_positions)
+
+    # Appends recorded API position batches and updates the segment times incrementally
+    ingest_parser = commands.add_parser('ingest', help='Ingest recorded SPTrans API position responses.')
+    ingest_parser.add_argument('file', nargs='+', help='File with one /Posicao JSON response per line.')
+    ingest_parser.add_argument('--batch-size', type=int, default=60, help='Responses processed per batch.')
+    ingest_parser.set_defaults(handler=ingest_positions)
+
+    # Rebuilds the passenger aggregates of the routes with newly loaded passengers rows
+    passengers_parser = commands.add_parser('passengers', help='Refresh the passenger_stats table.')
+    passengers_parser.set_defaults(handler=refresh_passengers)
+
+    # Fills an empty database with a synthetic city, to benchmark without the Kaggle data
+    generate_parser = commands.add_parser('generate', help='Create a synthetic bus database.')
+    generate_parser.add_argument('--routes', type=int, default=10, help='Number of routes.')
+    generate_parser.add_argument('--vehicles', type=int, default=4, help='Vehicles serving each route.')
+    generate_parser.add_argument('--days', type=int, default=7, help='Days of bus positions.')
+    generate_parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    generate_parser.set_defaults(handler=generate_database)
+
+    # Times the query functions and callbacks, and compares them against a previous run
+    benchmark_parser = commands.add_parser('benchmark', help='Benchmark the query functions and Dash callbacks.')
+    benchmark_parser.add_argument('--routes', type=int, default=5, help='Number of routes sampled.')
+    benchmark_parser.add_argument('--repeat', type=int, default=10, help='Timed calls per function.')
+    benchmark_parser.add_argument('--warm', action='store_true', help='Time cached calls instead of cold ones.')
+    benchmark_parser.add_argument('--no-callbacks', action='store_true', help='Only benchmark the query functions.')
+    benchmark_parser.add_argument('--output', help='Results file (default benchmarks/<date>.json).')
+    benchmark_parser.add_argument('--compare', help='Results file to compare against. Exits with 1 on regressions.')
+    benchmark_parser.set_defaults(handler=run_benchmark)
+
+    args = parser.parse_args()
+
+    if args.database:
+        db.configure('sqlite:///' + args.database)
+
+    with db.connect(write=True) as connection:
+        args.handler(connection, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,21 @@
+from utils import cache
+
+
+def test_versioned_entries(monkeypatch):
+    monkeypatch.setattr(cache, 'cache', cache.Cache())
+
+    version = [1]
+    calls = []
+
+    @cache.cached('test', lambda: version[0])
+    def square(value):
+        calls.append(value)
+        return value ** 2
+
+    assert square(3) == 9 and square(3) == 9
+    assert calls == [3]
+
+    # New data: the entry computed from the old one is not served any more.
+    version[0] = 2
+    assert square(3) == 9
+    assert calls == [3, 3]
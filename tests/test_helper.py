@@ -0,0 +1,111 @@
+import math
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils import helper
+
+
+def crossings_frame(vehicles=3, fixes=12, stops=5, seed=0):
+    # Crossings of several vehicles reporting at the same moments, so their fix times collide. Each movement segment
+    # crosses a random run of stops, and the first fix of every vehicle has no previous fix.
+    generator = np.random.default_rng(seed)
+    start = pd.Timestamp('2020-01-06 08:00', tz='America/Sao_Paulo')
+
+    rows = []
+    for vehicle in range(vehicles):
+        times = [start + pd.Timedelta(minutes=minute) for minute in range(fixes)]
+        for fix in range(fixes):
+            previous_ta = times[fix - 1] if fix else pd.NaT
+            for stop_sequence in sorted(generator.choice(np.arange(1, stops + 1), generator.integers(0, 4),
+                                                         replace=False)):
+                rows.append({'p': vehicle, 'ta': times[fix], 'previous_ta': previous_ta,
+                             'stop_sequence': int(stop_sequence), 'time': float(generator.uniform(0, 1))})
+
+    return pd.DataFrame(rows)
+
+
+def scalar_times_between_stops(crossings):
+    return np.array([helper.get_time_between_stops(row.stop_sequence, row.ta, row.previous_ta, row.time, crossings)
+                     for row in crossings.itertuples()], dtype=float)
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_times_between_stops_matches_scalar(seed):
+    crossings = crossings_frame(seed=seed)
+
+    expected = scalar_times_between_stops(crossings)
+    result = helper.times_between_stops(crossings['stop_sequence'], crossings['ta'], crossings['previous_ta'],
+                                        crossings['time'])
+
+    assert np.isnan(expected).any() and not np.isnan(expected).all()
+    np.testing.assert_allclose(result, expected, rtol=0, atol=1e-6)
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_times_between_stops_pairs_within_each_vehicle(seed):
+    crossings = crossings_frame(seed=seed)
+
+    expected = np.concatenate([scalar_times_between_stops(group.reset_index(drop=True))
+                               for _, group in crossings.groupby('p', sort=True)])
+    result = helper.times_between_stops(crossings['stop_sequence'], crossings['ta'], crossings['previous_ta'],
+                                        crossings['time'], crossings['p'])
+
+    # The frame is ordered by vehicle, so the groups come out in the same order.
+    np.testing.assert_allclose(result, expected, rtol=0, atol=1e-6)
+
+
+def test_times_between_stops_without_previous_fix():
+    ta = pd.Series(pd.to_datetime(['2020-01-06 08:00', '2020-01-06 08:00']).tz_localize('America/Sao_Paulo'))
+    previous_ta = pd.Series([pd.NaT, pd.NaT], dtype=ta.dtype)
+
+    result = helper.times_between_stops([1, 2], ta, previous_ta, [0.2, 0.1])
+
+    # The second stop was reached before the first one on the same fix, and there is no previous fix to fall back on.
+    assert np.isnan(result).all()
+    assert len(helper.times_between_stops([], ta[:0], previous_ta[:0], [])) == 0
+
+
+def test_deltatimes_to_hours_matches_scalar():
+    # Durations of both signs with fractions of a second, which both versions truncate, and missing ones.
+    generator = np.random.default_rng(0)
+    deltas = pd.Series(pd.to_timedelta(generator.integers(-10 ** 13, 10 ** 13, 200), unit='ns'))
+    deltas[[0, 7]] = pd.NaT
+
+    # The scalar version gives None for NaT, which is not a Timedelta.
+    expected = [helper.deltatime_to_float(delta) for delta in deltas]
+    result = helper.deltatimes_to_hours(deltas)
+
+    assert expected[0] is None and expected[7] is None
+    np.testing.assert_allclose(result, np.array(expected, dtype=float), rtol=1e-12)
+
+
+def test_calculate_real_times_matches_scalar():
+    generator = np.random.default_rng(0)
+    count = 200
+    stop_lat, stop_lon = -23.55 + generator.normal(0, 0.01, count), -46.63 + generator.normal(0, 0.01, count)
+    previous_py = stop_lat + generator.normal(0, 0.002, count)
+    previous_px = stop_lon + generator.normal(0, 0.002, count)
+    py, px = stop_lat + generator.normal(0, 0.002, count), stop_lon + generator.normal(0, 0.002, count)
+    time = generator.uniform(0, 3, count)
+    previous_py[0] = np.nan
+
+    expected = [helper.calculate_real_time(*values) for values in zip(stop_lat, previous_py, stop_lon, previous_px,
+                                                                       py, px, time)]
+    result = helper.calculate_real_times(stop_lat, previous_py, stop_lon, previous_px, py, px, time)
+
+    assert math.isnan(expected[0])
+    np.testing.assert_allclose(result, expected, rtol=1e-12)
+
+
+def test_calculate_real_times_zero_length_segment():
+    # A bus standing still divides by zero in the scalar version; the batch version gives NaN for that row only.
+    with pytest.raises(ZeroDivisionError):
+        helper.calculate_real_time(-23.55, -23.56, -46.63, -46.64, -23.56, -46.64, 1.0)
+
+    result = helper.calculate_real_times([-23.55, -23.55], [-23.56, -23.56], [-46.63, -46.63], [-46.64, -46.64],
+                                         [-23.56, -23.54], [-46.64, -46.62], [1.0, 1.0])
+
+    assert math.isnan(result[0])
+    assert result[1] == pytest.approx(helper.calculate_real_time(-23.55, -23.56, -46.63, -46.64, -23.54, -46.62, 1.0))
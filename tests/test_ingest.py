@@ -0,0 +1,109 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, text
+
+from utils import catalog, config, ingest, schema, segments, synthetic
+
+
+ROUTE = '1000-10'
+
+# 14:00 in São Paulo: positions from then on reach the database through the ingestion.
+SPLIT = '2020-03-02T17:00:00Z'
+
+FIXTURE = os.path.join(os.path.dirname(__file__), 'fixtures', 'posicao.jsonl')
+
+
+@pytest.fixture
+def connection(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path / "bus.db"}')
+    with engine.connect() as connection:
+        synthetic.generate(connection, routes=1, vehicles=2, days=1, passenger_days=7)
+        schema.prepare(connection)
+        yield connection
+    engine.dispose()
+
+
+def read_table(connection, query, **params):
+    result = connection.execute(text(query), **params)
+    return pd.DataFrame(result.fetchall(), columns=result.keys())
+
+
+def record_responses(positions, path, start, interval=10):
+    # Polls the positions like the /Posicao endpoint would have been every interval seconds from start: each
+    # response holds the latest fix of every vehicle, grouped by line, so a fix is repeated until the next one.
+    positions = positions.assign(time=pd.to_datetime(positions['ta'], utc=True))
+    polls = pd.date_range(pd.Timestamp(start), positions['time'].max() + pd.Timedelta(seconds=interval),
+                          freq=f'{interval}s')
+
+    with open(path, 'w', encoding='utf-8') as file:
+        for poll in polls:
+            latest = positions[positions['time'] <= poll].groupby('p').tail(1)
+            latest = latest[latest['time'] > poll - pd.Timedelta(minutes=5)]
+
+            lines = [{'c': c, 'cl': int(cl), 'sl': 1, 'lt0': 'Centro', 'lt1': 'Terminal', 'qv': len(fixes),
+                      'vs': [{'p': int(fix.p), 'a': True, 'ta': fix.ta, 'py': fix.py, 'px': fix.px}
+                             for fix in fixes.itertuples()]}
+                     for (c, cl), fixes in latest.groupby(['c', 'cl'])]
+            file.write(json.dumps({'hr': poll.tz_convert('America/Sao_Paulo').strftime('%H:%M'), 'l': lines}) + '\n')
+
+
+def split_history(connection, tmp_path):
+    # Keeps the positions before SPLIT in the database and records the rest, starting a few polls early so the
+    # first responses repeat fixes that are already stored.
+    positions = read_table(connection, """SELECT c, cl, p, ta, py, px FROM bus_position ORDER BY p, ta""")
+    connection.execute(text("""DELETE FROM bus_position WHERE ta >= :split"""), split=SPLIT)
+
+    path = str(tmp_path / 'posicao.jsonl')
+    record_responses(positions, path, pd.Timestamp(SPLIT) - pd.Timedelta(minutes=2))
+
+    return positions, path
+
+
+def test_ingest_matches_rebuild(connection, tmp_path):
+    positions, path = split_history(connection, tmp_path)
+    segments.build_segment_times(connection, [ROUTE])
+
+    assert ingest.ingest_files(connection, [path]) == (positions['ta'] >= SPLIT).sum()
+    assert connection.execute(text("""SELECT COUNT(*) FROM bus_position""")).scalar() == len(positions)
+
+    query = """SELECT direction_id, stop_sequence, weekday, hour, total_minutes, observations FROM segment_times
+               WHERE route_id = :route ORDER BY direction_id, stop_sequence, weekday, hour"""
+    ingested = read_table(connection, query, route=ROUTE)
+    segments.build_segment_times(connection, [ROUTE])
+    rebuilt = read_table(connection, query, route=ROUTE)
+
+    # Crossings on both sides of the split are counted once, as when every position is processed at once.
+    columns = ['direction_id', 'stop_sequence', 'weekday', 'hour', 'observations']
+    pd.testing.assert_frame_equal(ingested[columns], rebuilt[columns])
+    np.testing.assert_allclose(ingested['total_minutes'], rebuilt['total_minutes'], rtol=1e-9)
+
+
+def test_ingest_leaves_unbuilt_routes_to_the_builder(connection, tmp_path):
+    positions, path = split_history(connection, tmp_path)
+
+    assert ingest.ingest_files(connection, [path]) == (positions['ta'] >= SPLIT).sum()
+    assert connection.execute(text("""SELECT COUNT(*) FROM segment_times""")).scalar() == 0
+
+
+def test_ingest_recorded_responses(connection):
+    # The recorded responses repeat fixes the API had already reported, and include lines without vehicles.
+    assert ingest.ingest_files(connection, [FIXTURE]) == 4
+    assert ingest.ingest_files(connection, [FIXTURE]) == 0
+
+    stored = read_table(connection, """SELECT cl, p, ta FROM bus_position WHERE p IN (90001, 90002) ORDER BY p, ta""")
+    assert stored.values.tolist() == [[1000, 90001, '2020-03-03T10:00:05Z'], [1000, 90001, '2020-03-03T10:00:35Z'],
+                                      [33768, 90002, '2020-03-03T09:59:50Z'], [33768, 90002, '2020-03-03T10:00:20Z']]
+
+
+def test_ingest_changes_the_database_version(connection, tmp_path, monkeypatch):
+    # Travel times are cached under the database version, so new positions must change it.
+    monkeypatch.setattr(config, 'DATABASE_URL', f'sqlite:///{tmp_path / "bus.db"}')
+    version = catalog.database_version()
+
+    ingest.ingest_files(connection, [FIXTURE])
+
+    assert version is not None and catalog.database_version() != version
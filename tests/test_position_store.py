@@ -0,0 +1,47 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+from utils import position_store
+
+
+def positions(start, count):
+    # One fix a second, numbered by id, all on 2020-03-02 (UTC).
+    ids = np.arange(start, start + count)
+    return pd.DataFrame({'id': ids, 'p': 1, 'ta': 1583150000 + ids, 'py': -23.55, 'px': -46.63})
+
+
+def test_append_positions(tmp_path):
+    position_store.write_route('1000-10', positions(0, 100), str(tmp_path))
+    position_store.append_positions('1000-10', positions(100, 50), str(tmp_path))
+
+    stored = position_store.load_positions('1000-10', path=str(tmp_path))
+    chunks = list(position_store.iter_positions('1000-10', 40, path=str(tmp_path)))
+
+    assert stored['id'].tolist() == list(range(150))
+    assert [len(chunk) for chunk in chunks] == [40, 40, 40, 30]
+    assert sorted(path.name for path in (tmp_path / '1000-10').iterdir()) == ['2020-03-02']
+
+
+def test_reads_while_a_partition_is_replaced(tmp_path):
+    position_store.write_route('1000-10', positions(0, 1000), str(tmp_path))
+
+    done = threading.Event()
+
+    def append():
+        start = 1000
+        while not done.is_set():
+            position_store.append_positions('1000-10', positions(start, 10), str(tmp_path))
+            start += 10
+
+    writer = threading.Thread(target=append)
+    writer.start()
+    try:
+        # Every read sees one version of the partition, whole.
+        for _ in range(300):
+            stored = position_store.load_positions('1000-10', path=str(tmp_path))
+            assert len(stored) >= 1000 and (stored['id'].to_numpy() == np.arange(len(stored))).all()
+    finally:
+        done.set()
+        writer.join()
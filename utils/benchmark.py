@@ -0,0 +1,203 @@
+"""Benchmarks of the query layer and the Dash callbacks.
+
+Times every query function and callback on a sample of routes of the configured database (a real bus.db or one
+made by utils/synthetic.py) and reports latency percentiles and peak Python memory. Results are saved as JSON, with
+the size of the database they were measured on, so a later run can be compared against them.
+"""
+import datetime
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+
+from sqlalchemy import inspect, text
+import numpy as np
+import plotly
+
+from utils import db, jobs, queries
+from utils.cache import cache
+
+
+TABLES = ['routes', 'trips', 'stops', 'stop_times', 'shapes', 'bus_position', 'passengers', 'segment_times']
+
+QUERIES = {
+    'get_routes': lambda case: queries.get_routes(),
+    'get_stops': lambda case: queries.get_stops(case['route']),
+    'get_shape': lambda case: queries.get_shape(case['route']),
+    'weekly_passengers': lambda case: queries.weekly_passengers(case['route']),
+    'historial_timedelta': lambda case: queries.historial_timedelta(case['route'], case['first_stop'],
+                                                                    case['second_stop'], case['hour']),
+    'travel_time': lambda case: queries.travel_time(case['route'], case['first_stop'], case['second_stop'],
+                                                    case['hour'])
+}
+
+
+def sample_cases(connection, routes=5, hour='08:00', seed=0):
+    """Picks routes with stops and, for each, a pair of stops a quarter and three quarters along direction 0."""
+
+    result = connection.execute(text("""SELECT route_id, stop_id, stop_sequence FROM route_stops
+                                        WHERE direction_id = 0 ORDER BY route_id, stop_sequence"""))
+    stops = {}
+    for route_id, stop_id, _ in result:
+        stops.setdefault(route_id, []).append(stop_id)
+
+    names = sorted(stops)
+    chosen = np.random.default_rng(seed).choice(len(names), min(routes, len(names)), replace=False)
+
+    cases = []
+    for index in sorted(chosen):
+        route_stops = stops[names[index]]
+        cases.append({'route': names[index], 'first_stop': route_stops[len(route_stops) // 4],
+                      'second_stop': route_stops[3 * len(route_stops) // 4], 'hour': hour})
+
+    return cases
+
+
+def _respond(callback, *args):
+    # Runs the function behind a Dash callback and serializes its output the way Dash sends it to the browser.
+    output = getattr(callback, '__wrapped__', callback)(*args)
+    json.dumps(output, cls=plotly.utils.PlotlyJSONEncoder)
+
+    return output
+
+
+def _time_graph(app, case):
+    # Queues the travel time job and polls it like the page does, until the graph is sent. Process pool workers keep
+    # their own cache, so cold timings need BUS_APP_JOB_BACKEND=thread or inline.
+    job = _respond(app.calc_time, case['route'], case['first_stop'], case['second_stop'], case['hour'], None)
+
+    n_intervals = 0
+    while _respond(app.update_time, job, n_intervals)[0] is app.dash.no_update:
+        n_intervals += 1
+        time.sleep(0.05)
+
+    jobs.queue.release(job['id'])
+
+
+def callbacks():
+    """The Dash callbacks, taking a case. Importing the app is slow and needs Dash, so it only happens here."""
+
+    import application as app
+
+    return {
+        'update_map': lambda case: _respond(app.update_map, case['route']),
+        'update_passengers': lambda case: _respond(app.update_passengers, case['route']),
+        'update_route_stops': lambda case: _respond(app.update_route_stops, case['route']),
+        'time_graph': lambda case: _time_graph(app, case)
+    }
+
+
+def measure(function, cases, repeat=10, warm=False):
+    """Calls function(case) repeat times, going round the cases, and returns its latency and memory statistics.
+
+    Calls start from an empty cache unless warm is set. The peak memory comes from one extra traced call, since
+    tracing slows the timed ones down.
+    """
+
+    if warm:
+        for case in cases:
+            function(case)
+
+    seconds = []
+    for call in range(repeat):
+        if not warm:
+            cache.invalidate()
+
+        now = time.perf_counter()
+        function(cases[call % len(cases)])
+        seconds.append(time.perf_counter() - now)
+
+    if not warm:
+        cache.invalidate()
+
+    tracemalloc.start()
+    try:
+        function(cases[0])
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    milliseconds = np.array(seconds) * 1000
+    return {'calls': repeat, 'mean_ms': milliseconds.mean(), 'p50_ms': np.percentile(milliseconds, 50),
+            'p90_ms': np.percentile(milliseconds, 90), 'p99_ms': np.percentile(milliseconds, 99),
+            'max_ms': milliseconds.max(), 'peak_memory_mb': peak / 2 ** 20}
+
+
+def database_size(connection):
+    """Counts the rows of the main tables, to tell at which scale results were measured."""
+
+    existing = inspect(connection).get_table_names()
+
+    return {table: connection.execute(text(f"""SELECT COUNT(*) FROM {table}""")).scalar() if table in existing
+            else None for table in TABLES}
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(routes=5, repeat=10, warm=False, include_callbacks=True, seed=0):
+    """Benchmarks every query function and, if include_callbacks is set, every Dash callback."""
+
+    queries.prepare_database()
+
+    with db.connect() as connection:
+        cases = sample_cases(connection, routes, seed=seed)
+        size = database_size(connection)
+
+    if not cases:
+        raise ValueError('The database has no routes with stops to benchmark.')
+
+    functions = dict(QUERIES, **(callbacks() if include_callbacks else {}))
+
+    results = {}
+    for name, function in functions.items():
+        results[name] = measure(function, cases, repeat, warm)
+        print(f'{name:<20} p50 {results[name]["p50_ms"]:9.1f} ms  p90 {results[name]["p90_ms"]:9.1f} ms  '
+              f'peak {results[name]["peak_memory_mb"]:7.1f} MB')
+
+    return {'date': datetime.datetime.now().isoformat(timespec='seconds'), 'commit': _commit(),
+            'python': platform.python_version(), 'database': size, 'routes': [case['route'] for case in cases],
+            'repeat': repeat, 'warm': warm, 'results': results}
+
+
+def save(report, path):
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=2, default=float)
+
+
+def load(path):
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)
+
+
+def compare(baseline, report, threshold=0.2):
+    """Prints the change of every function's median latency and peak memory against a baseline report.
+
+    Returns the names of the functions that got slower or used more memory by more than threshold (a fraction).
+    """
+
+    if baseline['database'] != report['database']:
+        print('Warning: the baseline was measured on a database of a different size.')
+
+    regressions = []
+    for name, result in report['results'].items():
+        before = baseline['results'].get(name)
+        if before is None:
+            continue
+
+        latency = result['p50_ms'] / before['p50_ms'] - 1 if before['p50_ms'] else 0
+        memory = result['peak_memory_mb'] / before['peak_memory_mb'] - 1 if before['peak_memory_mb'] else 0
+        regressed = latency > threshold or memory > threshold
+        if regressed:
+            regressions.append(name)
+
+        print(f'{name:<20} p50 {latency:+7.1%}  peak memory {memory:+7.1%}' + ('  REGRESSION' if regressed else ''))
+
+    return regressions
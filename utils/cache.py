@@ -0,0 +1,181 @@
+"""Route-level result cache shared by the Dash callbacks.
+
+Entries live in an in-process LRU with a TTL and, optionally, in a SQLite file so they survive restarts and are
+shared by the workers of a host. Concurrent misses on the same key wait for the first caller instead of running
+the same query again. Cached values are shared between callers and must be treated as read-only.
+"""
+from collections import OrderedDict
+import functools
+import pickle
+import sqlite3
+import threading
+import time
+
+from utils import config, metrics
+
+
+class DiskBackend:
+    """Stores pickled entries in a SQLite file, keeping the most recently used ones up to max_entries."""
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+
+        with self._connect() as connection:
+            connection.execute("""CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, expires REAL NOT NULL,
+                                  used REAL NOT NULL, value BLOB NOT NULL)""")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, key):
+        with self._connect() as connection:
+            row = connection.execute("""SELECT expires, value FROM cache WHERE key = ?""", (key,)).fetchone()
+            if row is None:
+                return None
+
+            if row[0] < time.time():
+                connection.execute("""DELETE FROM cache WHERE key = ?""", (key,))
+                return None
+
+            connection.execute("""UPDATE cache SET used = ? WHERE key = ?""", (time.time(), key))
+
+        return row[0], pickle.loads(row[1])
+
+    def set(self, key, value, expires):
+        with self._connect() as connection:
+            connection.execute("""INSERT OR REPLACE INTO cache (key, expires, used, value) VALUES (?, ?, ?, ?)""",
+                               (key, expires, time.time(), pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+            connection.execute("""DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY used DESC
+                                  LIMIT -1 OFFSET ?)""", (self.max_entries,))
+
+    def invalidate(self, prefix):
+        with self._connect() as connection:
+            connection.execute("""DELETE FROM cache WHERE substr(key, 1, ?) = ?""", (len(prefix), prefix))
+
+
+class Cache:
+    """In-process LRU cache with a TTL, hit/miss counters and an optional disk backend."""
+
+    def __init__(self, max_entries=256, ttl=3600, backend=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.backend = backend
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._loading = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] >= time.time():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return True, entry[1]
+                del self._entries[key]
+
+        if self.backend is not None:
+            entry = self.backend.get(key)
+            if entry is not None:
+                self._store(key, entry[1], entry[0])
+                with self._lock:
+                    self.hits += 1
+                return True, entry[1]
+
+        return False, None
+
+    def _store(self, key, value, expires):
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_compute(self, key, function):
+        """Returns the cached value for key, computing it with function() on a miss."""
+
+        found, value = self._lookup(key)
+        if found:
+            return value
+
+        # Only one caller computes a given key; the others wait for it and then read the cached value.
+        with self._lock:
+            loading = self._loading.setdefault(key, threading.Lock())
+
+        with loading:
+            found, value = self._lookup(key)
+            if found:
+                return value
+
+            with self._lock:
+                self.misses += 1
+
+            try:
+                value = function()
+                expires = time.time() + self.ttl
+                self._store(key, value, expires)
+                if self.backend is not None:
+                    self.backend.set(key, value, expires)
+            finally:
+                with self._lock:
+                    self._loading.pop(key, None)
+
+        return value
+
+    def invalidate(self, prefix=''):
+        """Drops every entry whose key starts with prefix (everything by default)."""
+
+        with self._lock:
+            for key in [key for key in self._entries if key.startswith(prefix)]:
+                del self._entries[key]
+
+        if self.backend is not None:
+            self.backend.invalidate(prefix)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+def make_key(namespace, *args):
+    return namespace + ':' + repr(args)
+
+
+def cached(namespace, version=None):
+    """Caches a function's results in the shared cache, keyed by namespace and positional arguments.
+
+    version, if given, is called on every call and what it returns is part of the key, so results computed from older
+    data stop being served as soon as it changes.
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args):
+            computed = []
+
+            def compute():
+                computed.append(True)
+                return function(*args)
+
+            key = make_key(namespace, *args) if version is None else make_key(namespace, version(), *args)
+            value = cache.get_or_compute(key, compute)
+            metrics.cache_lookup(namespace, hit=not computed)
+
+            return value
+
+        return wrapper
+
+    return decorator
+
+
+cache = Cache(config.CACHE_SIZE, config.CACHE_TTL,
+              DiskBackend(config.CACHE_PATH, config.CACHE_SIZE) if config.CACHE_PATH else None)
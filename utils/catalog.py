@@ -0,0 +1,97 @@
+"""Route catalog of the route dropdown.
+
+The options are built from the routes table once and kept in a small JSON file, keyed by the database file and its
+modification time, so new web workers read the file instead of querying and converting the routes again. Nothing is
+loaded until the first request asks for the options, and this module imports no heavy dependency.
+"""
+import json
+import os
+import threading
+
+from utils import config
+
+
+_catalog = None
+_lock = threading.Lock()
+
+
+def _database_path():
+    # Only SQLite databases are files with a modification time.
+    url = config.DATABASE_URL
+    if not url.startswith('sqlite:///'):
+        return None
+
+    path = url[len('sqlite:///'):].split('?')[0]
+    return None if path in ('', ':memory:') else os.path.abspath(path)
+
+
+def database_version():
+    """Returns the database file and its modification time, or None if there is no such file."""
+
+    path = _database_path()
+    try:
+        return [path, os.path.getmtime(path)] if path else None
+    except OSError:
+        return None
+
+
+def build_options():
+    """Queries the routes and converts them to dropdown options."""
+
+    from utils import queries
+
+    routes = queries.get_routes()[['route_long_name', 'route_id']]
+    routes.columns = ['label', 'value']
+
+    return routes.to_dict('records')
+
+
+def _read(version):
+    try:
+        with open(config.CATALOG_PATH, encoding='utf-8') as file:
+            catalog = json.load(file)
+    except (OSError, ValueError):
+        return None
+
+    return catalog['options'] if catalog.get('version') == version else None
+
+
+def _write(version, options):
+    # Written to a temporary file first so other workers never read half of it.
+    temporary = f'{config.CATALOG_PATH}.{os.getpid()}.tmp'
+    try:
+        with open(temporary, 'w', encoding='utf-8') as file:
+            json.dump({'version': version, 'options': options}, file)
+        os.replace(temporary, config.CATALOG_PATH)
+    except OSError as error:
+        print('Could not save the route catalog: ', error)
+
+
+def route_options():
+    """Gets the route dropdown options, from memory, the catalog file or the database, in that order.
+
+    Returns no options if the database cannot be read, and tries again on the next call.
+    """
+
+    global _catalog
+
+    version = database_version()
+
+    with _lock:
+        if _catalog is not None and _catalog[0] == version:
+            return _catalog[1]
+
+        options = _read(version) if version is not None else None
+        if options is None:
+            try:
+                options = build_options()
+            except Exception as error:
+                print('Could not load the routes: ', error)
+                return []
+
+            if version is not None:
+                _write(version, options)
+
+        _catalog = (version, options)
+
+    return options
@@ -0,0 +1,47 @@
+"""App settings, read from environment variables so every gunicorn worker is configured the same way."""
+import os
+import tempfile
+
+
+# Route-level query cache: maximum number of entries per process, seconds before an entry expires, and an optional
+# SQLite file shared by the workers of a host (in-process only when unset).
+CACHE_SIZE = int(os.environ.get('BUS_APP_CACHE_SIZE', 256))
+CACHE_TTL = float(os.environ.get('BUS_APP_CACHE_TTL', 3600))
+CACHE_PATH = os.environ.get('BUS_APP_CACHE_PATH') or None
+
+# Database the app reads from. SQLite databases are opened read-only for serving unless BUS_APP_DATABASE_READONLY is
+# 0; maintenance commands and the startup schema preparation always use a separate writable engine.
+DATABASE_URL = os.environ.get('BUS_APP_DATABASE_URL', 'sqlite:///../database/bus.db')
+DATABASE_READONLY = os.environ.get('BUS_APP_DATABASE_READONLY', '1') != '0'
+
+# Connection pool of each worker process.
+POOL_SIZE = int(os.environ.get('BUS_APP_POOL_SIZE', 5))
+POOL_MAX_OVERFLOW = int(os.environ.get('BUS_APP_POOL_MAX_OVERFLOW', 10))
+POOL_TIMEOUT = float(os.environ.get('BUS_APP_POOL_TIMEOUT', 30))
+POOL_RECYCLE = int(os.environ.get('BUS_APP_POOL_RECYCLE', 1800))
+
+# Background jobs for the travel-time graph: 'process' runs them in a process pool, 'thread' in a thread pool and
+# 'inline' right away in the calling thread (handy locally and for debugging).
+JOB_BACKEND = os.environ.get('BUS_APP_JOB_BACKEND', 'process')
+JOB_WORKERS = int(os.environ.get('BUS_APP_JOB_WORKERS', 2))
+# Seconds a finished job's result is kept for the page that asked for it.
+JOB_RESULT_TTL = float(os.environ.get('BUS_APP_JOB_RESULT_TTL', 600))
+
+# Columnar copy of bus_position, partitioned by route and date (see utils/position_store.py). Routes found there are
+# read from it instead of the database.
+POSITIONS_PATH = os.environ.get('BUS_APP_POSITIONS_PATH', '../database/positions')
+
+# Positions processed at a time when computing travel times from them, which bounds the memory a route takes however
+# much history it has. 0 processes a route's positions all at once.
+CHUNK_SIZE = int(os.environ.get('BUS_APP_CHUNK_SIZE', 200000))
+# Processes each chunk is split across, by vehicle. 1 computes everything in the calling process.
+COMPUTE_WORKERS = int(os.environ.get('BUS_APP_COMPUTE_WORKERS', 1))
+
+# Calls of a callback or query slower than this many seconds get their cProfile stats written to PROFILE_PATH.
+# Profiling is off when unset.
+PROFILE_THRESHOLD = os.environ.get('BUS_APP_PROFILE_THRESHOLD') or None
+PROFILE_THRESHOLD = float(PROFILE_THRESHOLD) if PROFILE_THRESHOLD is not None else None
+PROFILE_PATH = os.environ.get('BUS_APP_PROFILE_PATH', 'profiles')
+
+# File caching the options of the route dropdown between workers and restarts (see utils/catalog.py).
+CATALOG_PATH = os.environ.get('BUS_APP_CATALOG_PATH') or os.path.join(tempfile.gettempdir(), 'bus_app_routes.json')
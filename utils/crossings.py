@@ -0,0 +1,245 @@
+import numpy as np
+import pandas as pd
+
+from utils import helper, linref
+
+
+DAYS = ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday']
+
+
+def add_previous_fix(bus_position):
+    """Sorts positions by vehicle and time and adds the previous fix of the same vehicle to every row."""
+
+    bus_position = bus_position.sort_values(['p', 'ta'], ignore_index=True)
+
+    shifted_values = bus_position.groupby('p')[['ta', 'py', 'px']].shift(1)
+    shifted_values.columns = ['previous_ta', 'previous_py', 'previous_px']
+
+    return pd.concat([bus_position, shifted_values], axis=1)
+
+
+def _minutes(delta):
+    return delta / np.timedelta64(1, 's') / 60
+
+
+def detect_crossings(bus_position, stops, buffer=0):
+    """Finds every movement segment (previous fix -> fix) whose bounding box, grown by buffer metres, contains a stop.
+
+    Candidate stops come from a grid index of the stops (linref.StopGrid), so the cost grows with the number of
+    positions rather than with positions x stops. Returns one row per (segment, stop) with the minutes elapsed between
+    the previous fix and the moment the bus reached the stop, interpolated along the segment in metres.
+    """
+
+    stops = stops.drop_duplicates(['stop_id', 'stop_sequence'], ignore_index=True)
+    grid = linref.StopGrid(stops['stop_lat'], stops['stop_lon'])
+
+    x, y = grid.project(bus_position['py'].to_numpy(dtype=float), bus_position['px'].to_numpy(dtype=float))
+    previous_x, previous_y = grid.project(bus_position['previous_py'].to_numpy(dtype=float),
+                                          bus_position['previous_px'].to_numpy(dtype=float))
+
+    # NaN coordinates (first fix of each vehicle) give boxes without candidates.
+    position_index, stop_index = grid.in_boxes(np.fmin(x, previous_x), np.fmin(y, previous_y), np.fmax(x, previous_x),
+                                               np.fmax(y, previous_y), buffer)
+
+    crossings = bus_position[['p', 'id', 'ta', 'previous_ta']].iloc[position_index].reset_index(drop=True)
+    crossings['stop_id'] = stops['stop_id'].to_numpy()[stop_index]
+    crossings['stop_sequence'] = stops['stop_sequence'].to_numpy()[stop_index]
+
+    # Share of the segment covered until the stop, applied to the segment duration.
+    elapsed = _minutes(crossings['ta'] - crossings['previous_ta']).to_numpy(dtype=float)
+    candidates = bus_position.iloc[position_index]
+    crossings['time'] = helper.calculate_real_times(stops['stop_lat'].to_numpy()[stop_index], candidates['previous_py'],
+                                                    stops['stop_lon'].to_numpy()[stop_index], candidates['previous_px'],
+                                                    candidates['py'], candidates['px'], elapsed)
+
+    return crossings
+
+
+def pair_previous_stop(crossings):
+    """Adds the minutes spent since the same vehicle crossed the previous stop (stop_sequence - 1).
+
+    The previous crossing is looked up on the same movement segment first and, if that does not give a positive
+    duration, on the segment right before it (see helper.times_between_stops).
+    """
+
+    crossings = crossings.copy()
+    crossings['time_between_stops'] = helper.times_between_stops(crossings['stop_sequence'], crossings['ta'],
+                                                                 crossings['previous_ta'], crossings['time'],
+                                                                 crossings['p'])
+
+    return crossings
+
+
+def pair_consecutive_crossings(crossings, stops):
+    """Adds the minutes since the same vehicle reached the stop right before in the stop list.
+
+    Each vehicle's crossings are ordered by the moment the stop was reached, so a crossing whose predecessor is the
+    previous stop of the list gives the time between those two stops. Suited to engines that find every crossing
+    along the way, such as linref.detect_crossings.
+    """
+
+    sequences = np.unique(stops['stop_sequence'].to_numpy())
+    previous_sequence = pd.Series(sequences[:-1], index=sequences[1:])
+
+    crossings = crossings.copy()
+    crossings['crossed_at'] = crossings['previous_ta'] + pd.to_timedelta(crossings['time'], unit='m')
+    crossings.sort_values(['p', 'crossed_at'], ignore_index=True, inplace=True)
+
+    grouped = crossings.groupby('p')
+    last_sequence = grouped['stop_sequence'].shift(1).to_numpy()
+    last_crossed_at = grouped['crossed_at'].shift(1)
+
+    expected = crossings['stop_sequence'].map(previous_sequence).to_numpy()
+    elapsed = _minutes(crossings['crossed_at'] - last_crossed_at).to_numpy(dtype=float)
+    crossings['time_between_stops'] = np.where(last_sequence == expected, elapsed, np.nan)
+
+    return crossings
+
+
+def _hour_label(hour):
+    return str(hour).zfill(2) + ':' + '00'
+
+
+def partial_by_hour(crossings, max_minutes=10):
+    """Sums the time between stops per hour of the day and weekday, keeping the number of observations.
+
+    Partial sums of chunks of crossings are added up with merge_partials and averaged with mean_by_hour.
+    """
+
+    crossings = crossings.dropna(subset=['time_between_stops'])
+    crossings = crossings[crossings['time_between_stops'] < max_minutes]
+
+    agg = crossings.groupby([crossings['ta'].dt.hour, crossings['ta'].dt.day_name()])['time_between_stops']
+    agg = agg.agg(['sum', 'count'])
+
+    agg.index.names = ['hour', 'weekday']
+    agg.columns = ['total_minutes', 'observations']
+
+    return agg.reset_index()
+
+
+def merge_partials(partials, keys):
+    """Adds up the total_minutes and observations of partial aggregates sharing the same keys."""
+
+    if not partials:
+        return pd.DataFrame(columns=keys + ['total_minutes', 'observations'])
+
+    return pd.concat(partials, ignore_index=True).groupby(keys)[['total_minutes', 'observations']].sum().reset_index()
+
+
+def mean_by_hour(partial):
+    """Averages the time between stops per hour of the day and weekday, from partial_by_hour sums."""
+
+    agg = partial.set_index(['hour', 'weekday']).sort_index()
+    agg = (agg['total_minutes'] / agg['observations']).to_frame('time_between_stops')
+    agg = agg.reindex(DAYS, level=1)
+    agg = agg.reset_index()
+
+    agg['hour'] = agg['hour'].map(_hour_label)
+
+    return agg
+
+
+def aggregate_segments(crossings, max_minutes=10):
+    """Sums the time between stops per stop, weekday and hour of the day, keeping the number of observations."""
+
+    crossings = crossings.dropna(subset=['time_between_stops'])
+    crossings = crossings[crossings['time_between_stops'] < max_minutes]
+
+    agg = crossings.groupby([crossings['stop_sequence'], crossings['stop_id'], crossings['ta'].dt.day_name(),
+                             crossings['ta'].dt.hour])['time_between_stops'].agg(['sum', 'count'])
+
+    agg.index.names = ['stop_sequence', 'stop_id', 'weekday', 'hour']
+    agg.columns = ['total_minutes', 'observations']
+    agg = agg.reset_index()
+
+    agg['hour'] = agg['hour'].map(_hour_label)
+
+    return agg
+
+
+def _arrivals(crossings, stops, max_minutes):
+    # Chains each vehicle's crossings into runs of consecutive stops, broken wherever a stop is missed or a segment
+    # took max_minutes or more. Returns the run, the position of the stop in the stop list, the minutes since the
+    # run's first stop and the moment the stop was reached, for every crossing.
+    sequences = np.unique(stops['stop_sequence'].to_numpy())
+    previous_sequence = pd.Series(sequences[:-1], index=sequences[1:])
+
+    crossings = crossings.copy()
+    crossings['crossed_at'] = crossings['previous_ta'] + pd.to_timedelta(crossings['time'], unit='m')
+    crossings = crossings.dropna(subset=['crossed_at']).sort_values(['p', 'crossed_at'], ignore_index=True)
+
+    grouped = crossings.groupby('p')
+    time_between_stops = crossings['time_between_stops'].to_numpy(dtype=float)
+    with np.errstate(invalid='ignore'):
+        continues = ((time_between_stops < max_minutes) & grouped['p'].shift(1).notna().to_numpy() &
+                     (grouped['stop_sequence'].shift(1).to_numpy() ==
+                      crossings['stop_sequence'].map(previous_sequence).to_numpy()))
+
+    run = np.cumsum(~continues) - 1
+    minutes = pd.Series(np.where(continues, time_between_stops, 0)).groupby(run).cumsum().to_numpy()
+    position = np.searchsorted(sequences, crossings['stop_sequence'].to_numpy())
+
+    return run, position, minutes, crossings['crossed_at'], sequences
+
+
+def travel_time_matrix(crossings, stops, percentiles=(50, 90), max_minutes=10):
+    """Computes the travel time between every pair of stops of one direction, per weekday and hour of departure.
+
+    Takes paired crossings (time_between_stops) of a single direction and its stops. A trip from one stop to a later
+    one is timed whenever a vehicle crossed every stop in between without a break, so all pairs come from the same
+    pass over the crossings. Returns one row per (from_sequence, to_sequence, weekday, hour) that has observations,
+    with their count and the given percentiles of the minutes (p50, p90, ...).
+    """
+
+    columns = ['from_sequence', 'to_sequence', 'weekday', 'hour', 'observations'] + [f'p{q}' for q in percentiles]
+    if crossings.empty:
+        return pd.DataFrame(columns=columns)
+
+    run, position, minutes, crossed_at, sequences = _arrivals(crossings, stops, max_minutes)
+    stop_count = len(sequences)
+
+    # Minutes since the start of the run at each stop, and weekday and hour (DAYS order) the stop was reached.
+    arrival = np.full((run[-1] + 1, stop_count), np.nan)
+    arrival[run, position] = minutes
+    departure = np.full(arrival.shape, -1)
+    departure[run, position] = ((crossed_at.dt.dayofweek.to_numpy() + 1) % 7) * 24 + crossed_at.dt.hour.to_numpy()
+
+    # One origin at a time, the runs leaving it are timed to every later stop at once. Sorting the times by
+    # (destination, weekday and hour) and then by value lets every percentile of every group be read off by index.
+    frames = []
+    for origin in range(stop_count - 1):
+        leaving = np.flatnonzero(~np.isnan(arrival[:, origin]))
+        elapsed = arrival[leaving, origin + 1:] - arrival[leaving, origin, np.newaxis]
+        group = (departure[leaving, origin, np.newaxis] * stop_count +
+                 np.arange(origin + 1, stop_count)[np.newaxis, :]) + np.zeros(elapsed.shape, dtype=int)
+
+        observed = ~np.isnan(elapsed)
+        elapsed, group = elapsed[observed], group[observed]
+        if not len(elapsed):
+            continue
+
+        order = np.lexsort((elapsed, group))
+        elapsed, group = elapsed[order], group[order]
+        groups, start, count = np.unique(group, return_index=True, return_counts=True)
+
+        frame = {'from_sequence': sequences[origin], 'to_sequence': sequences[groups % stop_count],
+                 'weekday': np.array(DAYS)[groups // stop_count // 24], 'hour': groups // stop_count % 24,
+                 'observations': count}
+
+        # Linear interpolation between the closest ranks, like np.percentile.
+        for q in percentiles:
+            rank = start + (count - 1) * q / 100
+            low = np.floor(rank).astype(int)
+            high = np.ceil(rank).astype(int)
+            frame[f'p{q}'] = elapsed[low] + (elapsed[high] - elapsed[low]) * (rank - low)
+
+        frames.append(pd.DataFrame(frame))
+
+    if not frames:
+        return pd.DataFrame(columns=columns)
+
+    matrix = pd.concat(frames, ignore_index=True)
+    matrix['hour'] = matrix['hour'].map(_hour_label)
+
+    return matrix[columns]
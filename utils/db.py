@@ -0,0 +1,115 @@
+"""Database access layer.
+
+Engines are created lazily, once per process, so gunicorn workers forked from a preloaded app never share the
+parent's connections. Callers check a connection out of the pool for the duration of a request:
+
+    with db.connect() as connection:
+        connection.execute(...)
+"""
+import os
+import threading
+
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool, QueuePool
+
+from utils import config
+
+
+_engines = {}
+_pid = os.getpid()
+_lock = threading.Lock()
+_url = None
+
+
+def configure(url=None):
+    """Points the layer at another database URL (the configured one by default) and drops existing engines."""
+
+    global _url
+
+    with _lock:
+        _url = url
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
+
+
+def _sqlite_url(url, readonly):
+    if not readonly or url.database in (None, '', ':memory:') or url.query:
+        return url
+
+    # Read-only SQLite is opened through a URI so the driver refuses writes and skips write locking.
+    return make_url('sqlite:///file:' + url.database + '?mode=ro&uri=true')
+
+
+def _on_sqlite_connect(readonly):
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # Larger page cache, memory-mapped reads and in-memory temporary tables for sorts and GROUP BYs.
+        cursor.execute('PRAGMA cache_size = -65536')
+        cursor.execute('PRAGMA mmap_size = 268435456')
+        cursor.execute('PRAGMA temp_store = MEMORY')
+        if readonly:
+            cursor.execute('PRAGMA query_only = 1')
+        cursor.close()
+
+    return on_connect
+
+
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    # A connection created by another process (inherited through fork) must never be used here.
+    pid = os.getpid()
+    if connection_record.info.setdefault('pid', pid) != pid:
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError('Connection belongs to pid %s, attempting to check out in pid %s' %
+                                     (connection_record.info['pid'], pid))
+
+
+def _create_engine(write):
+    url = make_url(_url or config.DATABASE_URL)
+    readonly = config.DATABASE_READONLY and not write
+    sqlite = url.get_backend_name() == 'sqlite'
+
+    if write:
+        # Maintenance work runs on one connection at a time; no need to keep any around.
+        options = {'poolclass': NullPool}
+    else:
+        options = {'poolclass': QueuePool, 'pool_size': config.POOL_SIZE, 'max_overflow': config.POOL_MAX_OVERFLOW,
+                   'pool_timeout': config.POOL_TIMEOUT, 'pool_recycle': config.POOL_RECYCLE,
+                   'pool_pre_ping': not sqlite}
+
+    if sqlite:
+        url = _sqlite_url(url, readonly)
+        # Pooled connections move between the threads serving requests, one thread at a time.
+        options['connect_args'] = {'check_same_thread': False}
+
+    engine = create_engine(url, **options)
+
+    if sqlite:
+        event.listen(engine, 'connect', _on_sqlite_connect(readonly))
+    event.listen(engine, 'checkout', _on_checkout)
+
+    return engine
+
+
+def get_engine(write=False):
+    """Returns this process's engine, creating it on first use (or first use after a fork)."""
+
+    global _pid
+
+    with _lock:
+        if _pid != os.getpid():
+            # Forget the parent's engines without closing their connections, which the parent still owns.
+            _engines.clear()
+            _pid = os.getpid()
+
+        if write not in _engines:
+            _engines[write] = _create_engine(write)
+
+        return _engines[write]
+
+
+def connect(write=False):
+    """Checks a connection out of the pool. Use it as a context manager so it goes back once the request is done."""
+
+    return get_engine(write).connect()
@@ -2,6 +2,8 @@ import pandas as pd
 import math
 import numpy as np
 
+from utils import linref
+
 
 def deltatime_to_float(delta):
     if type(delta) is pd._libs.tslibs.timedeltas.Timedelta:
@@ -12,8 +14,13 @@ def deltatime_to_float(delta):
 
 
 def calculate_real_time(stop_lat, previous_py, stop_lon, previous_px, py, px, time):
-    value = math.sqrt((stop_lat - previous_py)**2 + (stop_lon - previous_px)**2)
-    value = value/math.sqrt((py - previous_py)**2 + (px - previous_px)**2)
+    # Distances in metres, since a degree of longitude is shorter than one of latitude away from the equator.
+    stop_x, stop_y = linref.to_metres(stop_lat, stop_lon, stop_lat)
+    previous_x, previous_y = linref.to_metres(previous_py, previous_px, stop_lat)
+    x, y = linref.to_metres(py, px, stop_lat)
+
+    value = math.sqrt((stop_x - previous_x)**2 + (stop_y - previous_y)**2)
+    value = value/math.sqrt((x - previous_x)**2 + (y - previous_y)**2)
     return time * value
 
 
@@ -41,3 +48,85 @@ def get_time_between_stops(index, ta, previous_ta, bus_stop_time, association_df
                                          (association_df['stop_sequence'] == index - 1)]['previous_ta'].values[0] -
                                          np.datetime64('1970-01-01T00:00:00Z'))/np.timedelta64(1, 's')/60
     return np.nan
+
+
+# Batch versions of the functions above, taking whole columns (NumPy arrays or pandas Series) instead of one row.
+
+def deltatimes_to_hours(deltas):
+    """Converts timedeltas to hours, truncated to whole seconds like deltatime_to_float. NaT gives NaN."""
+
+    deltas = np.asarray(deltas, dtype='timedelta64[ns]')
+    hours = deltas.astype('timedelta64[s]').astype(np.int64) / 3600
+
+    return np.where(np.isnat(deltas), np.nan, hours)
+
+
+def calculate_real_times(stop_lat, previous_py, stop_lon, previous_px, py, px, time):
+    """Interpolates when each stop was reached along its movement segment, like calculate_real_time.
+
+    Returns time scaled by the distance from the previous fix to the stop over the length of the segment, both in
+    metres. Zero-length segments (a bus standing still) and missing coordinates give NaN.
+    """
+
+    stop_lat = np.asarray(stop_lat, dtype=float)
+    stop_x, stop_y = linref.to_metres(stop_lat, stop_lon, stop_lat)
+    previous_x, previous_y = linref.to_metres(previous_py, previous_px, stop_lat)
+    x, y = linref.to_metres(py, px, stop_lat)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        covered = np.hypot(stop_x - previous_x, stop_y - previous_y)
+        length = np.hypot(x - previous_x, y - previous_y)
+
+        return np.where(length > 0, np.asarray(time, dtype=float) * covered / length, np.nan)
+
+
+def times_between_stops(stop_sequence, ta, previous_ta, time, vehicle=None):
+    """Computes the minutes from the previous stop (stop_sequence - 1) of every crossing, like get_time_between_stops.
+
+    A crossing is paired with the first crossing of the previous stop made on the same fix (ta) if it came before
+    it, and otherwise with the one made on the previous fix (previous_ta), adding the duration of that segment.
+    Instead of filtering every crossing for each row, the crossings are sorted once on (vehicle, ta, stop_sequence)
+    and each pair is found with a binary search. Pairs are limited to the same vehicle when one is given. The first
+    stop and crossings without a pair get NaN.
+    """
+
+    stop_sequence = np.asarray(stop_sequence, dtype=np.int64)
+    ta = pd.Series(ta).reset_index(drop=True)
+    previous_ta = pd.Series(previous_ta).reset_index(drop=True)
+    time = np.asarray(time, dtype=float)
+
+    if not len(stop_sequence):
+        return np.array([], dtype=float)
+
+    # Integer codes of the fix times (equal times share one, NaT is -1) and of the vehicles, combined into one key.
+    codes = pd.factorize(pd.concat([ta, previous_ta], ignore_index=True))[0]
+    ta_code, previous_code = codes[:len(ta)], codes[len(ta):]
+    vehicle_code = np.zeros(len(ta), dtype=np.int64) if vehicle is None else pd.factorize(np.asarray(vehicle))[0]
+
+    span = stop_sequence.max() + 2
+
+    def key(fix_code, sequence):
+        return (vehicle_code * (len(codes) + 1) + fix_code) * span + sequence
+
+    # A stable sort keeps equal keys in their original order, so the leftmost match is the first crossing.
+    keys = key(ta_code, stop_sequence)
+    order = np.argsort(keys, kind='mergesort')
+    sorted_keys = keys[order]
+
+    def first_match(fix_code):
+        wanted = key(fix_code, stop_sequence - 1)
+        found = np.minimum(np.searchsorted(sorted_keys, wanted), len(sorted_keys) - 1)
+        matched = (sorted_keys[found] == wanted) & (fix_code >= 0) & (stop_sequence > 1)
+
+        return np.where(matched, order[found], -1)
+
+    same = first_match(ta_code)
+    adjacent = first_match(previous_code)
+
+    with np.errstate(invalid='ignore'):
+        same_fix = np.where(same >= 0, time - time[same], np.nan)
+
+        segment = ((ta - previous_ta) / np.timedelta64(1, 's') / 60).to_numpy(dtype=float)
+        previous_fix = np.where(adjacent >= 0, time - time[adjacent] + segment[adjacent], np.nan)
+
+        return np.where(same_fix > 0, same_fix, previous_fix)
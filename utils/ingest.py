@@ -0,0 +1,202 @@
+"""Incremental ingestion of SPTrans API position batches.
+
+Reads recorded responses of the API's /Posicao endpoint (one JSON document per line), appends the fixes that are
+newer than each vehicle's watermark to bus_position and adds the stop crossings they complete to segment_times.
+Only the new fixes and a short tail of each vehicle's previous fixes are processed. The first time a vehicle is seen,
+its tail is taken from the positions already in bus_position. Routes whose segment_times have not been built yet
+are left to segments.build_segment_times, which reads the appended fixes too.
+"""
+import json
+
+from sqlalchemy import bindparam, inspect, text
+import numpy as np
+import pandas as pd
+
+from utils import crossings, position_store, schema, segments
+from utils.cache import cache
+
+
+# Fixes of a vehicle kept before its watermark. Segment times above crossings.aggregate_segments' 10 minute cap are
+# discarded anyway, so older fixes can never be paired with a new crossing.
+TAIL_MINUTES = 15
+
+FIELDS = ['hr', 'c', 'cl', 'sl', 'lt0', 'lt1', 'qv', 'p', 'a', 'ta', 'py', 'px']
+
+
+def read_responses(path):
+    """Yields the API responses recorded in a file, one JSON document per line."""
+
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def flatten(responses):
+    """Turns API responses into one row per vehicle fix, with the fields of its line."""
+
+    rows = []
+    for response in responses:
+        for line in response.get('l') or []:
+            for vehicle in line.get('vs') or []:
+                row = dict(line, **vehicle)
+                row['hr'] = response.get('hr')
+                rows.append([row.get(field) for field in FIELDS])
+
+    return pd.DataFrame(rows, columns=FIELDS)
+
+
+def _read_tail(connection, vehicles):
+    query = text("""SELECT p, ta, cl, id, py, px FROM ingest_tail WHERE p IN :vehicles""")
+    query = query.bindparams(bindparam('vehicles', expanding=True))
+    result = connection.execute(query, vehicles=vehicles)
+
+    return pd.DataFrame(result.fetchall(), columns=['p', 'ta', 'cl', 'id', 'py', 'px'])
+
+
+def _write_tail(connection, vehicles, tail):
+    query = text("""DELETE FROM ingest_tail WHERE p IN :vehicles""")
+    connection.execute(query.bindparams(bindparam('vehicles', expanding=True)), vehicles=vehicles)
+
+    schema.insert_rows(connection, 'ingest_tail', tail[['p', 'ta', 'cl', 'id', 'py', 'px']])
+
+
+def _seed_tail(connection, positions):
+    # Latest fixes in bus_position of vehicles without a tail, from TAIL_MINUTES before their first fix of the batch.
+    # ta holds the API's ISO 8601 UTC times, which sort as text.
+    since = pd.to_datetime(positions['ta'], utc=True).min() - pd.Timedelta(minutes=TAIL_MINUTES)
+
+    query = text("""SELECT p, ta, cl, id, py, px FROM bus_position
+                    WHERE cl IN :lines AND p IN :vehicles AND ta >= :since""")
+    query = query.bindparams(bindparam('lines', expanding=True), bindparam('vehicles', expanding=True))
+    result = connection.execute(query, lines=[int(cl) for cl in positions['cl'].unique()],
+                                vehicles=[int(p) for p in positions['p'].unique()],
+                                since=since.strftime('%Y-%m-%dT%H:%M:%SZ'))
+
+    return pd.DataFrame(result.fetchall(), columns=['p', 'ta', 'cl', 'id', 'py', 'px'])
+
+
+def _has_segment_times(connection, route):
+    query = text("""SELECT 1 FROM segment_times WHERE route_id = :route_id LIMIT 1""")
+    return connection.execute(query, route_id=route).first() is not None
+
+
+def _append_positions(connection, positions):
+    # Only the columns bus_position actually has are written, and ids continue after the largest one.
+    columns = [column['name'] for column in inspect(connection).get_columns('bus_position')]
+
+    if 'id' in columns:
+        last_id = connection.execute(text("""SELECT MAX(id) FROM bus_position""")).scalar()
+        positions['id'] = np.arange(len(positions)) + (0 if last_id is None else last_id + 1)
+
+    schema.insert_rows(connection, 'bus_position', positions[[column for column in positions if column in columns]])
+
+
+def _after_watermark(frame, watermark):
+    # Rows of vehicles without a watermark are all new.
+    limit = frame['p'].map(watermark).to_numpy(dtype=float)
+    epoch = position_store.to_epoch(frame['ta'])
+
+    return np.isnan(limit) | (epoch > limit)
+
+
+def _segment_times(connection, route, positions, watermark):
+    """Aggregates the crossings completed by fixes newer than the watermark of their vehicle."""
+
+    positions = crossings.add_previous_fix(positions)
+    sequence = segments.route_stop_sequence(connection, route)
+    stop_crossings = segments.route_crossings(positions, sequence, segments.route_shapes(connection, route))
+    stop_crossings = stop_crossings[_after_watermark(stop_crossings, watermark)]
+
+    frames = []
+    for direction_id, direction_crossings in stop_crossings.groupby('direction_id'):
+        agg = crossings.aggregate_segments(direction_crossings)
+        agg['direction_id'] = direction_id
+        agg['route_id'] = route
+        frames.append(agg)
+
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+
+def ingest_batch(connection, positions):
+    """Appends a batch of fixes (flatten's columns) and updates segment_times with the crossings they complete.
+
+    Returns the number of new fixes.
+    """
+
+    positions = positions.dropna(subset=['p', 'ta', 'py', 'px']).drop_duplicates(['p', 'ta'])
+    if positions.empty:
+        return 0
+
+    positions = positions.copy()
+    positions['time'] = pd.to_datetime(positions['ta'], utc=True).dt.tz_convert('America/Sao_Paulo')
+    vehicles = [int(p) for p in positions['p'].unique()]
+
+    with connection.begin():
+        tail = _read_tail(connection, vehicles)
+        unseen = positions[~positions['p'].isin(tail['p'])]
+        if not unseen.empty:
+            tail = pd.concat([tail, _seed_tail(connection, unseen)], ignore_index=True)
+        tail['time'] = pd.to_datetime(tail['ta'], utc=True).dt.tz_convert('America/Sao_Paulo')
+        watermark = pd.Series(position_store.to_epoch(tail['ta']), index=tail['p'].to_numpy()).groupby(level=0).max()
+
+        # The API keeps reporting a vehicle's last fix until it sends a new one: only fixes past the watermark count.
+        new = positions[_after_watermark(positions, watermark)].copy()
+        if new.empty:
+            return 0
+
+        _append_positions(connection, new)
+
+        # Segment times of every route the new fixes belong to, with the tail of each vehicle in front of them. Routes
+        # without segment times yet get all of theirs when they are built, and would only get partial rows here.
+        route_map = pd.DataFrame(connection.execute(text("""SELECT cl, route_id FROM route_map""")).fetchall(),
+                                 columns=['cl', 'route_id'])
+        combined = pd.concat([tail, new[['p', 'ta', 'cl', 'id', 'py', 'px', 'time']]], ignore_index=True, sort=False)
+        combined = combined.merge(route_map, on='cl')
+
+        for route, frame in combined.groupby('route_id'):
+            frame = frame[['id', 'p', 'time', 'py', 'px']].rename(columns={'time': 'ta'})
+            if _has_segment_times(connection, route):
+                schema.add_segment_times(connection, _segment_times(connection, route, frame, watermark))
+
+            # Keeps the columnar copy of the route, if there is one, in step with bus_position.
+            if position_store.has_route(route):
+                stored = frame[_after_watermark(frame, watermark)]
+                position_store.append_positions(route, stored.assign(ta=position_store.to_epoch(stored['ta'])))
+
+        # Keeps the last TAIL_MINUTES of each vehicle, and at least its newest fix.
+        tail = pd.concat([tail, new], ignore_index=True, sort=False).sort_values(['p', 'time'])
+        newest = tail.groupby('p')['time'].transform('max')
+        tail = tail[tail['time'] >= newest - pd.Timedelta(minutes=TAIL_MINUTES)]
+        _write_tail(connection, vehicles, tail)
+
+    return len(new)
+
+
+def ingest_files(connection, paths, batch_size=60):
+    """Ingests recorded API responses, batch_size responses at a time."""
+
+    schema.prepare(connection)
+
+    total = 0
+    for path in paths:
+        batch = []
+        for response in read_responses(path):
+            batch.append(response)
+            if len(batch) == batch_size:
+                total += ingest_batch(connection, flatten(batch))
+                batch = []
+
+        if batch:
+            total += ingest_batch(connection, flatten(batch))
+
+        print(f'{path}: {total} new positions so far')
+
+    # Cached travel times are keyed by the database's modification time (catalog.database_version), so the web
+    # workers stop serving them on their own. Their entries in the shared disk cache are dropped here.
+    cache.invalidate('travel_time:')
+    cache.invalidate('historical:')
+    cache.invalidate('travel_matrix:')
+
+    return total
@@ -0,0 +1,191 @@
+"""Job queue running heavy analyses outside the web request.
+
+A callback submits a job and gets its id back right away; the page then polls the job's status. Identical
+requests share one job, and a job nobody is waiting for any more is cancelled if it has not started yet (a running
+job finishes in its worker and its result is dropped). Job ids are derived from the function and its arguments, so
+a web worker that is polled for a job it never saw can submit the same job under the same id.
+"""
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+import hashlib
+import os
+import threading
+import time
+
+from utils import config, metrics
+
+
+class InlineExecutor:
+    """Stand-in for a pool that runs each job in the submitting thread."""
+
+    def submit(self, function, *args):
+        future = Future()
+        future.set_running_or_notify_cancel()
+        try:
+            future.set_result(function(*args))
+        except Exception as error:
+            future.set_exception(error)
+        return future
+
+
+class Job:
+
+    def __init__(self, key, future):
+        self.id = job_id(key)
+        self.key = key
+        self.future = future
+        self.submitted = time.time()
+        self.finished = None
+        self.subscribers = 1
+        self.measured = False
+
+
+def job_id(key):
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+
+def _measured(function, *args):
+    # Runs in a job worker process, whose metrics the web worker's /metrics never sees, so they are sent back with
+    # the result. A worker runs one job at a time, so its registry only holds this job's metrics.
+    metrics.registry.clear()
+    result = function(*args)
+
+    return result, metrics.registry.snapshot()
+
+
+def _finished(job, future):
+    job.finished = time.time()
+
+    if job.measured and not future.cancelled() and future.exception() is None:
+        metrics.registry.merge(future.result()[1])
+
+
+def _reusable(job):
+    # Pending, running and successful jobs can be shared; failed or cancelled ones are submitted again.
+    if job.future is None or not job.future.done():
+        return True
+
+    return not job.future.cancelled() and job.future.exception() is None
+
+
+class JobQueue:
+
+    def __init__(self, backend='process', workers=2, result_ttl=600):
+        self.backend = backend
+        self.workers = workers
+        self.result_ttl = result_ttl
+
+        self._executor = None
+        self._pid = None
+        self._jobs = {}
+        self._by_key = {}
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        # Pools are not shared across fork: each web worker starts its own on first use.
+        if self._executor is None or self._pid != os.getpid():
+            if self.backend == 'process':
+                self._executor = ProcessPoolExecutor(self.workers)
+            elif self.backend == 'thread':
+                self._executor = ThreadPoolExecutor(self.workers)
+            else:
+                self._executor = InlineExecutor()
+            self._pid = os.getpid()
+            self._jobs.clear()
+            self._by_key.clear()
+
+        return self._executor
+
+    def _prune(self):
+        now = time.time()
+        for job in [job for job in self._jobs.values() if job.finished and now - job.finished > self.result_ttl]:
+            self._forget(job)
+
+    def _forget(self, job):
+        self._jobs.pop(job.id, None)
+        if self._by_key.get(job.key) is job:
+            del self._by_key[job.key]
+
+    def submit(self, function, *args):
+        """Queues function(*args) and returns the job id. An identical pending or running job is reused."""
+
+        key = (function.__module__, function.__qualname__) + args
+
+        with self._lock:
+            self._prune()
+            executor = self._get_executor()
+
+            job = self._by_key.get(key)
+            if job is not None and _reusable(job):
+                job.subscribers += 1
+                return job.id
+
+            job = Job(key, None)
+            self._jobs[job.id] = job
+            self._by_key[key] = job
+
+            # Pools only queue the job, so it is handed over under the lock and a release always finds its future.
+            # The inline executor runs it right away, so that is done after the lock is released.
+            if not isinstance(executor, InlineExecutor):
+                self._start(job, executor, function, args)
+
+        if job.future is None:
+            self._start(job, executor, function, args)
+
+        return job.id
+
+    def _start(self, job, executor, function, args):
+        # Jobs run in other processes record their metrics there; they come back with the result (see _measured).
+        if self.backend == 'process':
+            job.measured = True
+            job.future = executor.submit(_measured, function, *args)
+        else:
+            job.future = executor.submit(function, *args)
+
+        job.future.add_done_callback(lambda future: _finished(job, future))
+
+    def release(self, id):
+        """Tells the queue one page stopped waiting for the job. Unwanted jobs are cancelled or dropped."""
+
+        with self._lock:
+            job = self._jobs.get(id)
+            if job is None:
+                return
+
+            job.subscribers -= 1
+            if job.subscribers <= 0:
+                # An inline job that has not returned yet has no future; like a running job, its result is dropped.
+                if job.future is not None:
+                    job.future.cancel()
+                self._forget(job)
+
+    def status(self, id):
+        """Returns the job's state ('queued', 'running', 'done', 'failed' or 'unknown') and seconds since submit."""
+
+        with self._lock:
+            job = self._jobs.get(id)
+
+        if job is None or job.future is None:
+            return {'state': 'unknown' if job is None else 'queued', 'elapsed': 0}
+
+        elapsed = time.time() - job.submitted
+        future = job.future
+
+        if future.done():
+            state = 'failed' if future.cancelled() or future.exception() is not None else 'done'
+        else:
+            state = 'running' if future.running() else 'queued'
+
+        return {'state': state, 'elapsed': elapsed}
+
+    def result(self, id):
+        """Returns the result of a finished job; raises the job's exception if it failed."""
+
+        with self._lock:
+            job = self._jobs[id]
+
+        result = job.future.result(timeout=0)
+
+        return result[0] if job.measured else result
+
+
+queue = JobQueue(config.JOB_BACKEND, config.JOB_WORKERS, config.JOB_RESULT_TTL)
@@ -0,0 +1,353 @@
+import numpy as np
+
+
+EARTH_RADIUS = 6371008.8
+
+
+def to_metres(lat, lon, origin_lat):
+    """Projects coordinates to a local equirectangular plane in metres, accurate enough at city scale."""
+
+    lat = np.radians(np.asarray(lat, dtype=float))
+    lon = np.radians(np.asarray(lon, dtype=float))
+
+    return EARTH_RADIUS * lon * np.cos(np.radians(origin_lat)), EARTH_RADIUS * lat
+
+
+def _ranges(starts, counts):
+    # Concatenates the ranges start, ..., start + count - 1 of every start and count.
+    counts = np.asarray(counts)
+    return np.repeat(starts, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+
+def _cells(x, y, cell_size):
+    return np.floor(x / cell_size).astype(np.int64), np.floor(y / cell_size).astype(np.int64)
+
+
+def _box_cells(low_x, low_y, high_x, high_y, cell_size, bounds=None):
+    # Every cell overlapping each box, as (box, column, row), only those within bounds (first column, first row,
+    # last column, last row) if given. Boxes with NaN corners have none.
+    valid = ~(np.isnan(low_x) | np.isnan(low_y) | np.isnan(high_x) | np.isnan(high_y))
+    low_column, low_row = _cells(np.where(valid, low_x, 0), np.where(valid, low_y, 0), cell_size)
+    high_column, high_row = _cells(np.where(valid, high_x, 0), np.where(valid, high_y, 0), cell_size)
+
+    if bounds is not None:
+        low_column, low_row = np.maximum(low_column, bounds[0]), np.maximum(low_row, bounds[1])
+        high_column, high_row = np.minimum(high_column, bounds[2]), np.minimum(high_row, bounds[3])
+
+    width = np.clip(high_column - low_column + 1, 0, None)
+    height = np.clip(high_row - low_row + 1, 0, None)
+    counts = np.where(valid, width * height, 0)
+
+    offset = _ranges(np.zeros(len(counts), dtype=np.int64), counts)
+    height = np.repeat(height, counts)
+
+    return (np.repeat(np.arange(len(counts)), counts), np.repeat(low_column, counts) + offset // height,
+            np.repeat(low_row, counts) + offset % height)
+
+
+class _Grid:
+    """Items bucketed into square cells of cell_size metres, an item in as many cells as it is listed in."""
+
+    def __init__(self, item, column, row, cell_size):
+        self.cell_size = cell_size
+        self.first_column = column.min() if len(column) else 0
+        self.first_row = row.min() if len(row) else 0
+        self.columns = column.max() - self.first_column + 1 if len(column) else 0
+        self.rows = row.max() - self.first_row + 1 if len(row) else 0
+
+        # Items sorted by cell, with the first item and the number of items of every occupied cell.
+        key = (column - self.first_column) * self.rows + (row - self.first_row)
+        order = np.argsort(key, kind='mergesort')
+        self.items = item[order]
+        self.keys, self.starts, self.counts = np.unique(key[order], return_index=True, return_counts=True)
+
+    def cells(self, x, y):
+        return _cells(x, y, self.cell_size)
+
+    def box_cells(self, low_x, low_y, high_x, high_y):
+        # Cells outside the grid hold no items, so boxes are clipped to it.
+        bounds = (self.first_column, self.first_row, self.first_column + self.columns - 1,
+                  self.first_row + self.rows - 1)
+
+        return _box_cells(low_x, low_y, high_x, high_y, self.cell_size, bounds)
+
+    def lookup(self, query, column, row):
+        # Expands (query, cell) pairs into a (query, item) pair for every item in the cell, in the order they were
+        # listed. Cells outside the grid have none.
+        inside = ((column >= self.first_column) & (column < self.first_column + self.columns) &
+                  (row >= self.first_row) & (row < self.first_row + self.rows))
+        query = query[inside]
+        key = (column[inside] - self.first_column) * self.rows + (row[inside] - self.first_row)
+
+        found = np.minimum(np.searchsorted(self.keys, key), max(len(self.keys) - 1, 0))
+        occupied = self.keys[found] == key if len(self.keys) else np.zeros(len(key), dtype=bool)
+        query, found = query[occupied], found[occupied]
+
+        counts = self.counts[found]
+
+        return np.repeat(query, counts), self.items[_ranges(self.starts[found], counts)]
+
+
+class Polyline:
+    """A route shape in metres, able to locate points by their distance along it.
+
+    Segments are bucketed into square cells of cell_size metres, each segment into every cell its bounding box grown
+    by cell_size overlaps, so a point only needs to be measured against the segments of its own cell.
+    """
+
+    def __init__(self, lat, lon, origin_lat=None, cell_size=100):
+        lat = np.asarray(lat, dtype=float)
+        lon = np.asarray(lon, dtype=float)
+
+        self.origin_lat = lat.mean() if origin_lat is None else origin_lat
+        x, y = to_metres(lat, lon, self.origin_lat)
+
+        # Vertex i starts segment i. Zero-length segments are dropped so every segment has a direction.
+        keep = np.concatenate([[True], (np.diff(x) != 0) | (np.diff(y) != 0)])
+        self.x, self.y = x[keep], y[keep]
+
+        self.dx = np.diff(self.x)
+        self.dy = np.diff(self.y)
+        self.length = np.hypot(self.dx, self.dy)
+        self.offsets = np.concatenate([[0], np.cumsum(self.length)])
+
+        # Every segment goes into the cells its bounding box, grown by cell_size, overlaps.
+        self.cell_size = cell_size
+        self.grid = _Grid(*_box_cells(np.fmin(self.x[:-1], self.x[1:]) - cell_size,
+                                      np.fmin(self.y[:-1], self.y[1:]) - cell_size,
+                                      np.fmax(self.x[:-1], self.x[1:]) + cell_size,
+                                      np.fmax(self.y[:-1], self.y[1:]) + cell_size, cell_size), cell_size)
+
+    def _cell_segments(self, x, y):
+        # Expands every point into a (point, segment) pair for each segment of its cell. Points with a NaN coordinate
+        # or outside the grid have none.
+        valid = np.flatnonzero(~(np.isnan(x) | np.isnan(y)))
+
+        return self.grid.lookup(valid, *self.grid.cells(x[valid], y[valid]))
+
+    def _closest(self, x, y, point, segment):
+        # Projects each point onto each of its paired segments and keeps the closest one, the first segment on ties.
+        # Pairs come grouped by point, with segments in ascending order. Returns the points that had a pair, their
+        # distance along the shape and their distance to it.
+        if not len(point):
+            return point, np.array([]), np.array([])
+
+        rel_x = x[point] - self.x[segment]
+        rel_y = y[point] - self.y[segment]
+
+        t = np.clip((rel_x * self.dx[segment] + rel_y * self.dy[segment]) / self.length[segment] ** 2, 0, 1)
+        squared = (rel_x - t * self.dx[segment]) ** 2 + (rel_y - t * self.dy[segment]) ** 2
+
+        starts = np.flatnonzero(np.concatenate([[True], point[1:] != point[:-1]]))
+        closest = squared == np.repeat(np.minimum.reduceat(squared, starts), np.diff(np.append(starts, len(point))))
+        first = np.flatnonzero(closest)
+        first = first[np.concatenate([[True], point[first][1:] != point[first][:-1]])]
+
+        point, segment, t = point[first], segment[first], t[first]
+
+        return point, self.offsets[segment] + t * self.length[segment], np.sqrt(squared[first])
+
+    def locate(self, lat, lon, chunk_size=20000):
+        """Returns the distance along the shape of the closest point to each coordinate and the distance to it.
+
+        Coordinates are measured against the segments of their grid cell, chunk_size at a time. That finds the
+        closest segment of every coordinate within cell_size metres of the shape. The few further away are measured
+        against every segment, in chunks that shrink as the shape grows, so memory stays bounded either way.
+        """
+
+        x, y = to_metres(lat, lon, self.origin_lat)
+        offset = np.full(x.shape, np.nan)
+        distance = np.full(x.shape, np.nan)
+
+        if not len(self.length):
+            return offset, distance
+
+        for start in range(0, len(x), chunk_size):
+            chunk_x, chunk_y = x[start:start + chunk_size], y[start:start + chunk_size]
+            point, segment = self._cell_segments(chunk_x, chunk_y)
+            point, point_offset, point_distance = self._closest(chunk_x, chunk_y, point, segment)
+
+            near = point_distance <= self.cell_size
+            offset[start + point[near]] = point_offset[near]
+            distance[start + point[near]] = point_distance[near]
+
+        far = np.flatnonzero(np.isnan(distance) & ~np.isnan(x) & ~np.isnan(y))
+        step = max(1, chunk_size * 10 // len(self.length))
+        for start in range(0, len(far), step):
+            rows = far[start:start + step]
+            point = np.repeat(np.arange(len(rows)), len(self.length))
+            segment = np.tile(np.arange(len(self.length)), len(rows))
+
+            point, point_offset, point_distance = self._closest(x[rows], y[rows], point, segment)
+            offset[rows[point]] = point_offset
+            distance[rows[point]] = point_distance
+
+        return offset, distance
+
+
+def offsets_along(bus_position, polyline, max_distance=100, reset_distance=500):
+    """Adds each fix's distance along the shape (offset) and the previous fix's offset to the positions.
+
+    Fixes further than max_distance metres from the shape get no offset. Backward GPS jitter is flattened with a
+    running maximum per vehicle, which restarts whenever the bus starts a new trip: its offset drops by more than
+    reset_distance metres, or it falls that far behind the running maximum while driving back along the shape.
+    """
+
+    offset, distance = polyline.locate(bus_position['py'].to_numpy(), bus_position['px'].to_numpy())
+    offset[distance > max_distance] = np.nan
+
+    positions = bus_position[['p', 'id', 'ta', 'previous_ta']].copy()
+    positions['offset'] = offset
+
+    # Fixes off the shape must not hide the drop of a new trip, so the last offset on the shape is carried forward.
+    vehicle = positions['p']
+    previous = positions['offset'].groupby(vehicle).ffill().groupby(vehicle).shift(1)
+    new_trip = positions['offset'] < previous - reset_distance
+
+    # A bus heading back along the shape (serving the other direction) falls behind its running maximum gradually.
+    # Every stretch spent behind it ends a trip, and the next trip starts where the bus was furthest back.
+    running = positions.groupby([vehicle, new_trip.groupby(vehicle).cumsum()])['offset'].cummax()
+    behind = positions['offset'] < running - reset_distance
+    stretch = (behind & ~behind.groupby(vehicle).shift(1, fill_value=False)).cumsum()
+    furthest = positions.index.isin(positions['offset'][behind].groupby(stretch[behind]).idxmin())
+
+    # The next trip stays behind the previous trip's maximum until it gets close to it, so a fix jittering back
+    # across the limit starts a stretch of its own. A stretch only counts if its furthest point back is
+    # reset_distance behind the furthest the bus got since the previous stretch.
+    segment = (new_trip | furthest).groupby(vehicle).cumsum()
+    reached = positions['offset'].groupby([vehicle, segment]).transform('max').groupby(vehicle).shift(1)
+    new_trip |= furthest & (positions['offset'] < reached - reset_distance).to_numpy()
+
+    trip = new_trip.groupby(vehicle).cumsum()
+    positions['offset'] = positions.groupby([vehicle, trip])['offset'].cummax()
+
+    positions['previous_offset'] = positions.groupby('p')['offset'].shift(1)
+    positions.loc[new_trip, 'previous_offset'] = np.nan
+
+    return positions
+
+
+def detect_crossings(bus_position, stops, polyline, max_distance=100, reset_distance=500):
+    """Finds stop crossings by comparing stop offsets against the offsets of each movement segment.
+
+    Takes positions with their previous fix (crossings.add_previous_fix) and returns the same columns as
+    crossings.detect_crossings, so both engines can be paired and aggregated the same way.
+    """
+
+    stops = stops.drop_duplicates(['stop_id', 'stop_sequence'], ignore_index=True)
+    stop_offset, _ = polyline.locate(stops['stop_lat'].to_numpy(), stops['stop_lon'].to_numpy())
+
+    order = np.argsort(stop_offset, kind='mergesort')
+    stop_offset = stop_offset[order]
+    stops = stops.iloc[order].reset_index(drop=True)
+
+    positions = offsets_along(bus_position, polyline, max_distance, reset_distance)
+    offset = positions['offset'].to_numpy()
+    previous_offset = positions['previous_offset'].to_numpy()
+
+    # A forward segment crosses every stop whose offset falls in (previous_offset, offset].
+    with np.errstate(invalid='ignore'):
+        forward = np.flatnonzero(offset > previous_offset)
+    low = np.searchsorted(stop_offset, previous_offset[forward], side='right')
+    high = np.searchsorted(stop_offset, offset[forward], side='right')
+
+    counts = high - low
+    position_index = np.repeat(forward, counts)
+    stop_index = _ranges(low, counts)
+
+    crossings = positions[['p', 'id', 'ta', 'previous_ta']].iloc[position_index].reset_index(drop=True)
+    crossings['stop_id'] = stops['stop_id'].to_numpy()[stop_index]
+    crossings['stop_sequence'] = stops['stop_sequence'].to_numpy()[stop_index]
+
+    share = ((stop_offset[stop_index] - previous_offset[position_index]) /
+             (offset[position_index] - previous_offset[position_index]))
+    elapsed = (crossings['ta'] - crossings['previous_ta']) / np.timedelta64(1, 's') / 60
+    crossings['time'] = elapsed.to_numpy(dtype=float) * share
+
+    return crossings
+
+
+def pixel_size(zoom, lat):
+    """Returns the size in metres of a pixel of a web map (512 pixel tiles) at the given zoom and latitude."""
+
+    return 2 * np.pi * EARTH_RADIUS * np.cos(np.radians(lat)) / 512 / 2 ** zoom
+
+
+def simplify(lat, lon, tolerance):
+    """Returns a mask of the vertices of a line to keep so that it stays within tolerance metres of the original.
+
+    Uses the Douglas-Peucker algorithm: the vertex furthest from the line between two kept vertices is kept if it is
+    further than tolerance, and both halves are simplified the same way. The first and last vertices are always kept.
+    """
+
+    lat = np.asarray(lat, dtype=float)
+    x, y = to_metres(lat, lon, lat.mean() if len(lat) else 0)
+
+    keep = np.zeros(len(x), dtype=bool)
+    keep[[0, -1] if len(x) else []] = True
+
+    pending = [(0, len(x) - 1)]
+    while pending:
+        start, end = pending.pop()
+        if end - start < 2:
+            continue
+
+        # Distance of the inner vertices to the segment start -> end.
+        rel_x = x[start + 1:end] - x[start]
+        rel_y = y[start + 1:end] - y[start]
+        dx, dy = x[end] - x[start], y[end] - y[start]
+        length_squared = dx ** 2 + dy ** 2
+
+        t = np.clip((rel_x * dx + rel_y * dy) / length_squared, 0, 1) if length_squared else 0
+        distance = np.hypot(rel_x - t * dx, rel_y - t * dy)
+
+        furthest = np.argmax(distance)
+        if distance[furthest] > tolerance:
+            middle = start + 1 + furthest
+            keep[middle] = True
+            pending += [(start, middle), (middle, end)]
+
+    return keep
+
+
+class StopGrid:
+    """Points (usually stops) bucketed into square cells of cell_size metres, to find the ones inside boxes or near
+    other points without testing every one of them."""
+
+    def __init__(self, lat, lon, cell_size=250, origin_lat=None):
+        lat = np.asarray(lat, dtype=float)
+        lon = np.asarray(lon, dtype=float)
+
+        self.origin_lat = (lat.mean() if len(lat) else 0) if origin_lat is None else origin_lat
+        self.cell_size = cell_size
+        self.x, self.y = self.project(lat, lon)
+        self.grid = _Grid(np.arange(len(self.x)), *_cells(self.x, self.y, cell_size), cell_size)
+
+    def project(self, lat, lon):
+        """Converts coordinates to the metres the grid is built in."""
+
+        return to_metres(lat, lon, self.origin_lat)
+
+    def in_boxes(self, low_x, low_y, high_x, high_y, buffer=0):
+        """Returns the (box, point) index pairs of the points inside each box, grown by buffer metres on every side."""
+
+        low_x, low_y = np.asarray(low_x, dtype=float) - buffer, np.asarray(low_y, dtype=float) - buffer
+        high_x, high_y = np.asarray(high_x, dtype=float) + buffer, np.asarray(high_y, dtype=float) + buffer
+
+        box, point = self.grid.lookup(*self.grid.box_cells(low_x, low_y, high_x, high_y))
+        inside = ((low_x[box] <= self.x[point]) & (self.x[point] <= high_x[box]) &
+                  (low_y[box] <= self.y[point]) & (self.y[point] <= high_y[box]))
+
+        return box[inside], point[inside]
+
+    def near(self, x, y, radius):
+        """Returns the (query, point, distance) of every point within radius metres of each query point."""
+
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+
+        query, point = self.in_boxes(x, y, x, y, radius)
+        distance = np.hypot(self.x[point] - x[query], self.y[point] - y[query])
+        close = distance <= radius
+
+        return query[close], point[close], distance[close]
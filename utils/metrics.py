@@ -0,0 +1,242 @@
+"""In-process latency metrics of the Dash callbacks and the query layer.
+
+Callbacks and query functions are wrapped with timed(), which records their duration, and the stages inside them
+(SQL, data frame build, compute, figure build) are timed with stage(); the serialization of a callback's output is
+measured around the request (request_finished). Row counts and cache lookups are recorded too. Everything goes into
+histograms and counters of the current process, rendered in the Prometheus text format by render() for the app's
+/metrics route. Jobs run in a process pool send theirs back with their result (see utils/jobs.py). With
+BUS_APP_PROFILE_THRESHOLD set, calls slower than it are profiled and their cProfile stats dumped to
+BUS_APP_PROFILE_PATH.
+"""
+import cProfile
+import functools
+import os
+import threading
+import time
+
+from utils import config
+
+
+# Upper bounds of the histogram buckets, in seconds for durations, in rows for row counts and in bytes for sizes.
+SECONDS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+ROWS = [1, 10, 100, 1000, 10000, 100000, 1000000, 10000000]
+BYTES = [1000, 5000, 10000, 50000, 100000, 500000, 1000000, 5000000]
+
+
+class Histogram:
+    """Counts of observations per bucket, with their sum, like a Prometheus histogram."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = len(self.buckets)
+        for position, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = position
+                break
+
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    """Histograms and counters by metric name and labels."""
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, value, buckets=SECONDS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def clear(self):
+        with self._lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    def snapshot(self):
+        """Returns a copy of every histogram and counter that can be sent to another process and merged there."""
+
+        with self._lock:
+            histograms = {key: (histogram.buckets, list(histogram.counts), histogram.sum, histogram.count)
+                          for key, histogram in self.histograms.items()}
+            return histograms, dict(self.counters)
+
+    def merge(self, snapshot):
+        """Adds the observations and counts of another registry's snapshot() to this one."""
+
+        histograms, counters = snapshot
+        with self._lock:
+            for key, (buckets, counts, total, count) in histograms.items():
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram(buckets)
+                histogram.counts = [mine + theirs for mine, theirs in zip(histogram.counts, counts)]
+                histogram.sum += total
+                histogram.count += count
+
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+
+
+registry = Registry()
+
+# Name of the timed function running in each thread, so stages and row counts are attributed to it.
+_context = threading.local()
+
+
+def _current():
+    stack = getattr(_context, 'stack', None)
+    return stack[-1] if stack else 'none'
+
+
+class stage:
+    """Times a block of a timed function: with metrics.stage('sql'): ..."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        registry.observe('bus_app_stage_seconds', time.perf_counter() - self.start, function=_current(),
+                         stage=self.name)
+
+
+def rows(count, stage='result'):
+    """Records the number of rows a stage of the current function produced."""
+
+    registry.observe('bus_app_rows', count, ROWS, function=_current(), stage=stage)
+
+
+def cache_lookup(namespace, hit):
+    registry.increment('bus_app_cache_requests_total', namespace=namespace, result='hit' if hit else 'miss')
+
+
+def _dump_profile(profile, name, seconds):
+    os.makedirs(config.PROFILE_PATH, exist_ok=True)
+    path = os.path.join(config.PROFILE_PATH, f'{name}-{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}.prof')
+    profile.dump_stats(path)
+    print(f'{name} took {seconds:.2f}s, profile saved to {path}')
+
+
+def timed(kind):
+    """Records the duration and errors of every call of a function, labelled with its kind and name.
+
+    The outermost timed call of a thread is profiled when BUS_APP_PROFILE_THRESHOLD is set, and its profile kept if
+    it took longer than the threshold.
+    """
+
+    def decorator(function):
+        name = function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            stack = _context.__dict__.setdefault('stack', [])
+            profile = cProfile.Profile() if config.PROFILE_THRESHOLD is not None and not stack else None
+
+            stack.append(name)
+            start = time.perf_counter()
+            status = 'error'
+            try:
+                if profile is not None:
+                    try:
+                        profile.enable()
+                    except ValueError:
+                        # Another thread is being profiled already (one profiler at a time since Python 3.12).
+                        profile = None
+                result = function(*args, **kwargs)
+                status = 'ok'
+                return result
+            finally:
+                if profile is not None:
+                    profile.disable()
+                seconds = time.perf_counter() - start
+                stack.pop()
+                if not stack:
+                    _context.last = (name, seconds)
+
+                registry.observe('bus_app_call_seconds', seconds, kind=kind, function=name)
+                registry.increment('bus_app_calls_total', kind=kind, function=name, status=status)
+
+                if profile is not None and seconds > config.PROFILE_THRESHOLD:
+                    _dump_profile(profile, name, seconds)
+
+        return wrapper
+
+    return decorator
+
+
+def request_finished(output, seconds, size):
+    """Records a Dash update request of the current thread, given its output ids, duration and response size.
+
+    The time the request spent outside its callback (mostly Dash serializing the callback's output to JSON) is
+    recorded as the callback's serialization stage.
+    """
+
+    registry.observe('bus_app_request_seconds', seconds, output=output)
+    registry.observe('bus_app_response_bytes', size, BYTES, output=output)
+
+    last = getattr(_context, 'last', None)
+    if last is not None:
+        registry.observe('bus_app_stage_seconds', max(seconds - last[1], 0), function=last[0], stage='serialization')
+        _context.last = None
+
+
+def _labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ''
+
+    escaped = [(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for key, value in pairs]
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+def render():
+    """Renders every metric in the Prometheus text exposition format."""
+
+    with registry._lock:
+        histograms = sorted((key, histogram.buckets, list(histogram.counts), histogram.sum, histogram.count)
+                            for key, histogram in registry.histograms.items())
+        counters = sorted(registry.counters.items())
+
+    lines = []
+    typed = set()
+    for (name, labels), buckets, counts, total, count in histograms:
+        if name not in typed:
+            lines.append(f'# TYPE {name} histogram')
+            typed.add(name)
+
+        cumulative = 0
+        for bound, bucket_count in zip(buckets + ['+Inf'], counts):
+            cumulative += bucket_count
+            lines.append(f'{name}_bucket{_labels(labels, le=bound)} {cumulative}')
+        lines.append(f'{name}_sum{_labels(labels)} {total}')
+        lines.append(f'{name}_count{_labels(labels)} {count}')
+
+    for (name, labels), value in counters:
+        if name not in typed:
+            lines.append(f'# TYPE {name} counter')
+            typed.add(name)
+        lines.append(f'{name}{_labels(labels)} {value}')
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,125 @@
+from sqlalchemy import bindparam, text
+import pandas as pd
+import time
+
+from utils import crossings, schema
+
+
+PERIODS = ['quarter', 'month']
+
+# Counts of passengers rows per passengers.routes value, compared against passenger_loads to find new data.
+LOADS = """
+        SELECT routes, COUNT(*) AS observations, MAX(date) AS last_date
+        FROM passengers
+        GROUP BY routes
+        """
+
+
+def route_passengers(connection, routes):
+    """Gets the daily passenger counts of the given routes, one row per route and passengers row."""
+
+    query = text("""SELECT passenger_routes.route_id, passengers.date, passengers.passengers
+                    FROM passenger_routes
+                    JOIN passengers ON passengers.routes = passenger_routes.routes
+                    WHERE passenger_routes.route_id IN :routes""")
+    query = query.bindparams(bindparam('routes', expanding=True))
+    result = connection.execute(query, routes=list(routes))
+
+    return pd.DataFrame(result.fetchall(), columns=['route_id', 'date', 'passengers'])
+
+
+def aggregate_passengers(passengers):
+    """Sums the passengers of each route per weekday and quarter, and per weekday and month, in one pass."""
+
+    columns = ['route_id', 'period', 'period_value', 'weekday', 'total_passengers', 'observations']
+
+    passengers = passengers.dropna(subset=['date', 'passengers'])
+    date = pd.to_datetime(passengers['date'])
+    weekday = date.dt.day_name()
+
+    frames = []
+    for period in PERIODS:
+        agg = passengers.groupby([passengers['route_id'], getattr(date.dt, period), weekday])['passengers'].agg(
+            ['sum', 'count'])
+
+        agg.index.names = ['route_id', 'period_value', 'weekday']
+        agg.columns = ['total_passengers', 'observations']
+        agg = agg.reset_index()
+
+        agg['period'] = period
+        frames.append(agg)
+
+    return pd.concat(frames, ignore_index=True)[columns]
+
+
+def touched_routes(connection):
+    """Finds the passengers.routes values loaded since the last refresh and the routes they belong to."""
+
+    result = connection.execute(text(LOADS))
+    loads = pd.DataFrame(result.fetchall(), columns=['routes', 'observations', 'last_date'])
+
+    result = connection.execute(text("""SELECT routes, observations, last_date FROM passenger_loads"""))
+    done = pd.DataFrame(result.fetchall(), columns=['routes', 'observations', 'last_date'])
+
+    merged = loads.merge(done, how='left', on='routes', suffixes=('', '_done'))
+    changed = merged[(merged['observations'] != merged['observations_done']) |
+                     (merged['last_date'] != merged['last_date_done'])]
+    changed = changed[['routes', 'observations', 'last_date']]
+
+    if changed.empty:
+        return changed, []
+
+    query = text("""SELECT DISTINCT route_id FROM passenger_routes WHERE routes IN :routes""")
+    query = query.bindparams(bindparam('routes', expanding=True))
+    routes = [row[0] for row in connection.execute(query, routes=changed['routes'].tolist())]
+
+    return changed, routes
+
+
+def refresh_passenger_stats(connection):
+    """Rebuilds the passenger_stats rows of the routes with newly loaded passengers data.
+
+    The first run builds every route. Returns the refreshed routes.
+    """
+
+    schema.prepare(connection)
+
+    now = time.time()
+    with connection.begin():
+        # New passengers.routes values have to be matched to their routes first.
+        connection.execute(text(schema.PASSENGER_ROUTES_ROWS))
+
+        changed, routes = touched_routes(connection)
+        if changed.empty:
+            return []
+
+        if routes:
+            query = text("""DELETE FROM passenger_stats WHERE route_id IN :routes""")
+            connection.execute(query.bindparams(bindparam('routes', expanding=True)), routes=routes)
+            schema.insert_rows(connection, 'passenger_stats', aggregate_passengers(route_passengers(connection, routes)))
+
+        query = text("""DELETE FROM passenger_loads WHERE routes IN :routes""")
+        connection.execute(query.bindparams(bindparam('routes', expanding=True)), routes=changed['routes'].tolist())
+        schema.insert_rows(connection, 'passenger_loads', changed)
+
+    print(f'{len(routes)} routes refreshed in {time.time() - now:.1f}s')
+
+    return routes
+
+
+def weekday_passengers(connection, route, period='quarter'):
+    """Gets the average number of passengers of a route per weekday and quarter (or month)."""
+
+    query = text("""SELECT weekday, period_value, total_passengers / observations AS passengers
+                    FROM passenger_stats
+                    WHERE route_id = :route_id AND period = :period""")
+    result = connection.execute(query, route_id=route, period=period)
+
+    agg = pd.DataFrame(result.fetchall(), columns=['weekday', period, 'passengers'])
+
+    # Sunday first, as in the travel time graphs.
+    agg['weekday'] = pd.Categorical(agg['weekday'], categories=crossings.DAYS, ordered=True)
+    agg.sort_values(['weekday', period], ignore_index=True, inplace=True)
+    agg['weekday'] = agg['weekday'].astype(str)
+
+    return agg
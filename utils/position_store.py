@@ -0,0 +1,211 @@
+"""Columnar copy of bus_position, partitioned by route and date.
+
+Each partition is a directory <route_id>/<YYYY-MM-DD> (UTC date) holding one .npy file per column, sorted by time:
+
+    id.npy  int64     p.npy   int32     ta.npy  int64 (seconds since epoch, UTC)
+    py.npy  float32   px.npy  float32
+
+and a version file with an id unique to the write.
+
+Files are memory-mapped on read. A time range skips whole partitions by their date and slices the rest with a
+binary search on ta, so only the requested rows are paged in. A partition is rewritten next to the old one and swapped
+in with two renames; readers map every column of a partition and try again if its version changed meanwhile.
+"""
+import os
+import shutil
+import time
+import uuid
+
+from sqlalchemy import text
+import numpy as np
+import pandas as pd
+
+from utils import config
+
+
+COLUMNS = {'id': np.int64, 'p': np.int32, 'ta': np.int64, 'py': np.float32, 'px': np.float32}
+
+
+def _route_path(route, path=None):
+    return os.path.join(path or config.POSITIONS_PATH, route)
+
+
+def has_route(route, path=None):
+    return bool(path or config.POSITIONS_PATH) and os.path.isdir(_route_path(route, path))
+
+
+def to_epoch(ta):
+    """Converts the ta strings of bus_position to seconds since epoch."""
+
+    delta = pd.to_datetime(ta, utc=True) - pd.Timestamp('1970-01-01', tz='UTC')
+
+    return (delta // pd.Timedelta(seconds=1)).to_numpy(dtype=np.int64)
+
+
+def _epoch(value):
+    # Times without a timezone are taken as São Paulo time, like everything the app shows.
+    if value is None:
+        return None
+
+    value = pd.Timestamp(value)
+    if value.tzinfo is None:
+        value = value.tz_localize('America/Sao_Paulo')
+
+    return value.value // 10 ** 9
+
+
+def write_partition(directory, frame):
+    """Writes one partition next to any previous version of it, then swaps it in.
+
+    The old version is renamed aside before the new one is renamed in, so a reader sees one or the other, or for a
+    moment no partition at all (see _open_partition), but never a mix of both.
+    """
+
+    frame = frame.sort_values(['ta', 'p'], kind='mergesort')
+
+    temporary = directory + '.tmp'
+    shutil.rmtree(temporary, ignore_errors=True)
+    os.makedirs(temporary)
+
+    for column, dtype in COLUMNS.items():
+        np.save(os.path.join(temporary, column + '.npy'), frame[column].to_numpy(dtype=dtype))
+    with open(os.path.join(temporary, 'version'), 'w') as file:
+        file.write(uuid.uuid4().hex)
+
+    old = directory + '.old'
+    shutil.rmtree(old, ignore_errors=True)
+    if os.path.isdir(directory):
+        os.rename(directory, old)
+
+    os.rename(temporary, directory)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def write_route(route, positions, path=None):
+    """Replaces the stored positions of a route. Takes id, p, ta (epoch seconds), py and px columns."""
+
+    route_path = _route_path(route, path)
+    shutil.rmtree(route_path, ignore_errors=True)
+    os.makedirs(route_path)
+
+    dates = pd.to_datetime(positions['ta'], unit='s').dt.strftime('%Y-%m-%d')
+    for date, frame in positions.groupby(dates.to_numpy()):
+        write_partition(os.path.join(route_path, date), frame)
+
+
+def append_positions(route, positions, path=None):
+    """Adds positions (same columns as write_route) to a stored route, rewriting only the partitions they touch."""
+
+    route_path = _route_path(route, path)
+
+    dates = pd.to_datetime(positions['ta'], unit='s').dt.strftime('%Y-%m-%d')
+    for date, frame in positions.groupby(dates.to_numpy()):
+        directory = os.path.join(route_path, date)
+        if os.path.isdir(directory):
+            stored = pd.DataFrame({column: np.load(os.path.join(directory, column + '.npy')) for column in COLUMNS})
+            frame = pd.concat([stored, frame[list(COLUMNS)]], ignore_index=True)
+
+        write_partition(directory, frame)
+
+
+def export_positions(connection, routes=None, path=None):
+    """Copies bus_position into the columnar store, one route at a time."""
+
+    if routes is None:
+        routes = [row[0] for row in connection.execute(text("""SELECT DISTINCT route_id FROM route_map"""))]
+
+    query = text("""SELECT id, p, ta, py, px
+                    FROM route_map
+                    INNER JOIN bus_position ON route_map.cl = bus_position.cl
+                    WHERE route_map.route_id = :bus_route;""")
+
+    for route in routes:
+        result = connection.execute(query, bus_route=route)
+        positions = pd.DataFrame(result.fetchall(), columns=result.keys())
+        positions['ta'] = to_epoch(positions['ta'])
+
+        write_route(route, positions, path)
+        print(f'{route}: {len(positions)} positions exported')
+
+
+def _version(directory):
+    # Partitions written before versions were recorded have none, and any rewrite gives them one.
+    try:
+        with open(os.path.join(directory, 'version')) as file:
+            return file.read()
+    except FileNotFoundError:
+        if not os.path.isdir(directory):
+            raise
+        return ''
+
+
+def _open_partition(directory, attempts=20):
+    # Memory-maps every column of a partition. One being replaced is missing between the two renames of
+    # write_partition, or swapped while its columns are mapped, so it is opened again until every column comes from
+    # the same version.
+    for attempt in range(attempts):
+        try:
+            version = _version(directory)
+            values = {column: np.load(os.path.join(directory, column + '.npy'), mmap_mode='r') for column in COLUMNS}
+            if _version(directory) == version:
+                return values
+        except FileNotFoundError:
+            if attempt == attempts - 1:
+                raise
+
+        time.sleep(0.01)
+
+    raise OSError(f'{directory} kept being replaced while it was read')
+
+
+def _slices(route, start=None, end=None, path=None):
+    # Yields the columns of each partition and the row range of it between start and end, in time order.
+    start = _epoch(start)
+    end = _epoch(end)
+
+    route_path = _route_path(route, path)
+
+    # A partition being swapped in is only listed as <date>.old for a moment (see write_partition).
+    dates = {name[:-len('.old')] if name.endswith('.old') else name for name in os.listdir(route_path)
+             if not name.endswith('.tmp')}
+
+    for date in sorted(dates):
+        # Skips partitions entirely outside the range by their date.
+        day = pd.Timestamp(date).value // 10 ** 9
+        if (start is not None and day + 86400 <= start) or (end is not None and day > end):
+            continue
+
+        values = _open_partition(os.path.join(route_path, date))
+        low = 0 if start is None else np.searchsorted(values['ta'], start, side='left')
+        high = len(values['ta']) if end is None else np.searchsorted(values['ta'], end, side='right')
+        if low < high:
+            yield values, low, high
+
+
+def _frame(columns):
+    positions = pd.DataFrame({column: np.concatenate(parts) if parts else np.array([], dtype=COLUMNS[column])
+                              for column, parts in columns.items()})
+    positions['ta'] = pd.to_datetime(positions['ta'], unit='s', utc=True).dt.tz_convert('America/Sao_Paulo')
+
+    return positions
+
+
+def load_positions(route, start=None, end=None, path=None):
+    """Reads a route's positions between start and end (inclusive, any pandas-parsable time), in São Paulo time."""
+
+    columns = {column: [] for column in COLUMNS}
+
+    for values, low, high in _slices(route, start, end, path):
+        for column in COLUMNS:
+            columns[column].append(values[column][low:high])
+
+    return _frame(columns)
+
+
+def iter_positions(route, chunk_size, start=None, end=None, path=None):
+    """Reads a route's positions like load_positions, in time ordered chunks of at most chunk_size rows."""
+
+    for values, low, high in _slices(route, start, end, path):
+        for chunk_start in range(low, high, chunk_size):
+            chunk_end = min(chunk_start + chunk_size, high)
+            yield _frame({column: [column_values[chunk_start:chunk_end]] for column, column_values in values.items()})
@@ -1,71 +1,140 @@
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
+import numpy as np
 import pandas as pd
-import plotly.express as px
-import time
 
-from utils import helper
+from utils import catalog, crossings, db, linref, metrics, passengers, schema, segments
+from utils.cache import cached
 
 
-engine = create_engine('../database/bus.db')
-connection = engine.connect()
+def prepare_database():
+    """Creates the derived tables, indexes, route mappings and passenger aggregates the queries below rely on, if they
+    are missing."""
 
+    with db.connect(write=True) as connection:
+        schema.prepare(connection)
 
+        if connection.execute(text("""SELECT 1 FROM passenger_stats LIMIT 1""")).first() is None:
+            passengers.refresh_passenger_stats(connection)
+
+
+@metrics.timed('query')
 def get_routes():
     """Gets all routes from bus database. Returns route long name and id."""
     
     query = text("""SELECT route_id, route_long_name FROM routes""")
-    result = connection.execute(query)
-
-    routes = pd.DataFrame(result.fetchall(), columns=result.keys())
+    with db.connect() as connection:
+        with metrics.stage('sql'):
+            result = connection.execute(query)
+            rows = result.fetchall()
+
+    with metrics.stage('dataframe'):
+        routes = pd.DataFrame(rows, columns=result.keys())
+    metrics.rows(len(routes))
     
     return routes
 
 
+@metrics.timed('query')
+@cached('shape')
 def get_shape(route):
     """Gets the shape of a specific route."""
     if route:
-        route = '%' + route + '%'
 
         # Query accesses trips table where the row's route_id matches the route input. Then it joins the routes table
         # in order to get the route and text's color that should be plotted. Finally, this table is joined with the
-        # shapes table and we have access to the coordinates of the polyline.
-        query = text("""SELECT route_id, color, text_color, shapes.shape_id, index, shape_pt_lat, shape_pt_lon,
+        # shapes table and we have access to the coordinates of the polyline. Trips sharing a shape give it once.
+        query = text("""SELECT route_id, color, text_color, shapes.shape_id, "index", shape_pt_lat, shape_pt_lon,
                         shape_pt_sequence, shape_dist_traveled
-                        FROM (SELECT trips.route_id, route_color as color, route_text_color as text_color,trips.shape_id
+                        FROM (SELECT DISTINCT trips.route_id, route_color as color, route_text_color as text_color,
+                        trips.shape_id
                         FROM trips
                         JOIN routes ON routes.route_id = trips.route_id
-                        WHERE trips.route_id LIKE :bus_route) as A
+                        WHERE trips.route_id = :bus_route) as A
                         JOIN shapes ON A.shape_id = shapes.shape_id;""")
 
-        result = connection.execute(query, bus_route=route)
+        with db.connect() as connection:
+            with metrics.stage('sql'):
+                result = connection.execute(query, bus_route=route)
+                rows = result.fetchall()
 
-        shape = pd.DataFrame(result.fetchall(), columns=result.keys())
-
-        shape.sort_values(['shape_id', 'shape_pt_sequence'], ignore_index=True, inplace=True)
+        with metrics.stage('dataframe'):
+            shape = pd.DataFrame(rows, columns=result.keys())
+            shape.sort_values(['shape_id', 'shape_pt_sequence'], ignore_index=True, inplace=True)
+        metrics.rows(len(shape))
     else:
         shape = None
     
     return shape
 
 
+@metrics.timed('query')
+@cached('simplified_shape')
+def simplified_shape(shape_id, tolerance):
+    """Gets the coordinates of a shape, simplified to within tolerance metres and rounded to about a metre."""
+
+    query = text("""SELECT shape_pt_lat, shape_pt_lon FROM shapes
+                    WHERE shape_id = :shape_id
+                    ORDER BY shape_pt_sequence;""")
+    with db.connect() as connection:
+        with metrics.stage('sql'):
+            rows = connection.execute(query, shape_id=shape_id).fetchall()
+
+    with metrics.stage('compute'):
+        lat = np.array([row[0] for row in rows], dtype=float)
+        lon = np.array([row[1] for row in rows], dtype=float)
+        keep = linref.simplify(lat, lon, tolerance)
+    metrics.rows(int(keep.sum()))
+
+    return np.round(lat[keep], 5).tolist(), np.round(lon[keep], 5).tolist()
+
+
+@metrics.timed('query')
+@cached('map_shape')
+def get_map_shape(route, tolerance):
+    """Gets the lines of the distinct shapes of a route for the map, simplified to within tolerance metres.
+
+    Returns the route's color and the coordinates of all its shapes, each line ending with None so they are drawn
+    as one trace.
+    """
+
+    query = text("""SELECT DISTINCT trips.shape_id, route_color
+                    FROM trips
+                    JOIN routes ON routes.route_id = trips.route_id
+                    WHERE trips.route_id = :bus_route
+                    ORDER BY trips.shape_id;""")
+    with db.connect() as connection:
+        with metrics.stage('sql'):
+            shapes = connection.execute(query, bus_route=route).fetchall()
+
+    lat, lon = [], []
+    for shape_id, _ in shapes:
+        shape_lat, shape_lon = simplified_shape(shape_id, tolerance)
+        lat += shape_lat + [None]
+        lon += shape_lon + [None]
+
+    return {'color': shapes[0][1] if shapes else None, 'lat': lat, 'lon': lon}
+
+
+@metrics.timed('query')
+@cached('stops')
 def get_stops(route):
+    """Gets the ordered stops of each direction of a route, one row per stop and direction."""
 
     if route:
 
-        route = '%' + route + '%'
-
-        # Query accesses trips table where the row's route_id matches the route input. Then it joins the stop_times
-        # table as it has the stop_id column. Finally, we join the stops table and have access to all the stops names,
-        # latitudes, and longitudes of the route.
-        query = text("""SELECT stops.stop_id, stop_name, stop_lat, stop_lon
-                        FROM (SELECT *
-                        FROM trips
-                        INNER JOIN stop_times ON stop_times.trip_id = trips.trip_id
-                        WHERE route_id LIKE :bus_route) as A
-                        JOIN stops ON stops.stop_id = A.stop_id;""")
-        result = connection.execute(query, bus_route=route)
+        # The route_stops table holds the stop list of each direction in the order the buses serve it.
+        query = text("""SELECT stop_id, stop_name, stop_lat, stop_lon, stop_sequence, direction_id
+                        FROM route_stops
+                        WHERE route_id = :bus_route
+                        ORDER BY direction_id, stop_sequence;""")
+        with db.connect() as connection:
+            with metrics.stage('sql'):
+                result = connection.execute(query, bus_route=route)
+                rows = result.fetchall()
 
-        stops = pd.DataFrame(result.fetchall(), columns=result.keys())
+        with metrics.stage('dataframe'):
+            stops = pd.DataFrame(rows, columns=result.keys())
+        metrics.rows(len(stops))
 
     else:
 
@@ -74,38 +143,71 @@ def get_stops(route):
     return stops
 
 
-def weekly_passengers(route):
+@metrics.timed('query')
+@cached('stop_grid')
+def stop_grid():
+    """Gets every stop of the network and a grid index over them (linref.StopGrid), built once and cached."""
 
-    if route:
+    query = text("""SELECT stop_id, stop_name, stop_lat, stop_lon FROM stops""")
+    with db.connect() as connection:
+        with metrics.stage('sql'):
+            result = connection.execute(query)
+            rows = result.fetchall()
+
+    with metrics.stage('compute'):
+        stops = pd.DataFrame(rows, columns=result.keys())
+        grid = linref.StopGrid(stops['stop_lat'], stops['stop_lon'])
+    metrics.rows(len(stops))
+
+    return stops, grid
+
+
+@metrics.timed('query')
+def nearest_stops(lat, lon, radius=300):
+    """Gets the stops within radius metres of a point, closest first, with their distance in metres."""
+
+    stops, grid = stop_grid()
+
+    x, y = grid.project([lat], [lon])
+    _, point, distance = grid.near(x, y, radius)
+    order = np.argsort(distance, kind='mergesort')
+
+    nearby = stops.iloc[point[order]].reset_index(drop=True)
+    nearby['distance'] = distance[order]
+
+    return nearby
 
-        # Gets the date of the observation, the number of passenger, and the name of the inputt route.
-        route = '%' + route + '%'
-        query = text("""SELECT passengers.date, passengers.passengers, passengers.name FROM passengers
-                        WHERE routes LIKE :bus_route""")
 
-        result = connection.execute(query, bus_route=route)
-        passengers = pd.DataFrame(result.fetchall(), columns=result.keys())
+@metrics.timed('query')
+@cached('passengers')
+def passengers_by_weekday(route, period='quarter'):
+    """Gets the average number of passengers of a route per weekday and quarter (or month).
 
-        passengers.sort_values('date', ignore_index=True, inplace=True)
+    Reads the passenger_stats table, built once from the passengers table (see passengers.refresh_passenger_stats).
+    """
 
-        # Processes the date strings and sets it as index
-        passengers['date'] = pd.to_datetime(passengers['date'])
-        passengers.set_index('date', inplace=True)
+    with db.connect() as connection:
+        with metrics.stage('sql'):
+            agg = passengers.weekday_passengers(connection, route, period)
+    metrics.rows(len(agg))
 
-        # Groups everything by day of the week and then by quarter.
-        agg = passengers.groupby([(passengers.index.day_name()), passengers.index.quarter.values]).mean()
+    return agg
 
-        # Days of the week are not ordered the right way. Reindexes it with Sunday as the first day.
-        days = ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday']
-        agg = agg.reindex(days, level=0)
 
-        # Gives the indexes name
-        agg.index.names = ['weekday', 'quarter']
-        agg = agg.reset_index()
+@metrics.timed('query')
+def weekly_passengers(route):
+
+    # plotly.express is slow to import and only needed to build figures, so it is imported by the functions that do
+    import plotly.express as px
+
+    if route:
+
+        agg = passengers_by_weekday(route)
 
         # Create a plotly lineplot of the number of passengers per weekday, with quarter as a hue.
-        fig = px.line(agg, x='weekday', y='passengers', color='quarter',
-                      title=f'Average Number of Passengers X Weekday per Quarter')
+        with metrics.stage('figure'):
+            fig = px.line(agg, x='weekday', y='passengers', color='quarter',
+                          title=f'Average Number of Passengers X Weekday per Quarter')
 
     else:
 
@@ -114,134 +216,147 @@ def weekly_passengers(route):
     return fig
 
 
+@metrics.timed('query')
+@cached('historical', catalog.database_version)
+def historical_by_hour(route, stop_id_1, stop_id_2):
+    """Computes the time between two stops per hour and weekday from the raw positions.
+
+    Gives what segments.travel_time reads from segment_times once the route is built: the segments between the two
+    stops are timed the same way and their averages added up. Only the direction chosen by segments.stop_pair is used.
+    The result covers every hour, so changing only the hour is a cache lookup. Returns the data frame and the names of
+    the two stops in travel order.
+    """
+
+    with db.connect() as connection:
+        with metrics.stage('sql'):
+            # The stops from the first to the second one in the direction they are travelled, and the route's shapes.
+            sequence = segments.route_stop_sequence(connection, route)
+            pair = segments.stop_pair(sequence, stop_id_1, stop_id_2)
+            if pair is None:
+                return pd.DataFrame(columns=['hour', 'weekday', 'time_between_stops']), None, None
+
+            direction_id, start, end, first_stop, second_stop = pair
+            stops = sequence[(sequence['direction_id'] == direction_id) & sequence['stop_sequence'].between(start, end)]
+            shapes = segments.route_shapes(connection, route)
+
+        # Map matches the positions onto the direction's shape, finds when each stop was reached and pairs it with
+        # the previous stop using columnar operations and joins. Positions are read and processed in chunks, split
+        # across processes by vehicle when BUS_APP_COMPUTE_WORKERS is set, and their partial sums are added up.
+        with metrics.stage('compute'):
+            partials = segments.route_partials(connection, route, stops, shapes, segments.direction_segments)
+            table = crossings.merge_partials(partials, ['direction_id', 'stop_sequence', 'stop_id', 'weekday', 'hour'])
+            agg = segments.add_up_segments(table, start, segments.count_segments(sequence, direction_id, start, end))
+        metrics.rows(int(table['observations'].sum()), 'crossings')
+
+    return agg, first_stop, second_stop
+
+
+@metrics.timed('query')
 def historial_timedelta(route, stop_id_1, stop_id_2, hour):
 
-    print('Historical time query has started!')
-
-    now = time.time()
-    query = text("""
-                 SELECT A.c, id, p, ta, py, px
-                 FROM (SELECT * 
-                 FROM api_routes 
-                 WHERE c LIKE :bus_route) AS A
-                 INNER JOIN bus_position ON A.cl = bus_position.cl;
-                 """)
-
-    result = connection.execute(query, bus_route='1012-10')
-    bus_position = pd.DataFrame(result, columns=result.keys())
-
-    print('Master query time: ', time.time() - now)
-
-    now = time.time()
-    bus_position['ta'] = pd.to_datetime(bus_position['ta']).dt.tz_convert('America/Sao_Paulo')
-    bus_position.sort_values(['p', 'ta'], ignore_index=True, inplace=True)
-
-    grouped_cl = bus_position.groupby('p')
-    shifted_values = grouped_cl.shift(1)[['ta', 'py', 'px']]
-    shifted_values.columns = ['previous_ta', 'previous_py', 'previous_px']
-    bus_position = pd.concat([bus_position, shifted_values], axis=1)
-
-    bus_position['timedelta'] = bus_position.apply(
-        lambda x: (x['ta'] - x['previous_ta']) if x['previous_ta'] else None, axis=1)
-
-    bus_position['timedelta'] = bus_position['timedelta'].apply(helper.deltatime_to_float)
-
-    query = text("""
-                SELECT DISTINCT(B.stop_id), B.route_id, stop_lat, stop_lon, stop_name, B.stop_sequence, B.trip_id
-                FROM (SELECT A.route_id, A.trip_id, stop_id, stop_sequence
-                FROM (SELECT route_id, trip_id
-                FROM trips
-                WHERE route_id LIKE :bus_route) as A
-                JOIN stop_times ON A.trip_id = stop_times.trip_id) as B
-                JOIN stops ON B.stop_id = stops.stop_id
-                WHERE B.stop_id = :stop_id_1 OR B.stop_id = :stop_id_2
-                ORDER BY stop_sequence;
-                 """)
-    result = connection.execute(query, bus_route=route, stop_id_1=stop_id_1, stop_id_2=stop_id_2)
-    stops = pd.DataFrame(result, columns=result.keys())
-
-    first_stop, second_stop = (stops['stop_name'].unique())
-
-    print('We have done the second query in ', time.time() - now)
-    now = time.time()
-
-    index_list = []
-    id_list = []
-    for index, row in stops.iterrows():
-
-        i_list = list()
-        i_list.append(bus_position[
-                              (((bus_position['previous_py'] <= row['stop_lat']) & (row['stop_lat'] <= bus_position['py']) & (
-                                          bus_position['previous_px'] <= row['stop_lon']) & (
-                                            row['stop_lon'] <= bus_position['px'])) |
-                               ((bus_position['py'] <= row['stop_lat']) & (row['stop_lat'] <= bus_position['previous_py']) & (
-                                           bus_position['px'] <= row['stop_lon']) & (
-                                            row['stop_lon'] <= bus_position['previous_px'])) |
-                               ((bus_position['py'] <= row['stop_lat']) & (row['stop_lat'] <= bus_position['previous_py']) & (
-                                           bus_position['previous_px'] <= row['stop_lon']) & (
-                                            row['stop_lon'] <= bus_position['px'])) |
-                               ((bus_position['previous_py'] <= row['stop_lat']) & (row['stop_lat'] <= bus_position['py']) & (
-                                           bus_position['px'] <= row['stop_lon']) & (
-                                            row['stop_lon'] <= bus_position['previous_px'])))]['id'].values)
-
-        for i_value in i_list:
-            for value in i_value:
-                index_list.append(index)
-                id_list.append(value)
-    association_df = pd.DataFrame({'index': index_list, 'id': id_list})
-
-    print('Way to go. Since last observation we took ', time.time() - now)
-    now = time.time()
-
-    association_df['ta'] = association_df.apply(lambda x: bus_position[bus_position['id'] == x['id']]['ta'].values[0], axis=1)
-    association_df['previous_ta'] = association_df.apply(
-        lambda x: bus_position[bus_position['id'] == x['id']]['previous_ta'].values[0], axis=1)
-
-    association_df['stop_sequence'] = association_df.apply(
-        lambda x: stops[stops.index == x['index']]['stop_sequence'].values[0], axis=1)
-
-    print('Way to go 2. Since last observation we took ', time.time() - now)
-    now = time.time()
-
-    association_df['time'] = association_df.apply(lambda x: helper.calculate_real_time(stops.iloc[x['index']]['stop_lat'],
-                                                            bus_position[bus_position['id'] == x['id']][
-                                                                'previous_py'],
-                                                            stops.iloc[x['index']]['stop_lon'],
-                                                            bus_position[bus_position['id'] == x['id']][
-                                                                'previous_px'],
-                                                            bus_position[bus_position['id'] == x['id']]['py'],
-                                                            bus_position[bus_position['id'] == x['id']]['px'],
-                                                            ((time.mktime(
-                                                                x['ta'].timetuple()) / 60) - (
-                                                                         time.mktime(x[
-                                                            'previous_ta'].timetuple()) / 60))), axis=1)
-
-    association_df['time_between_stops'] = association_df.apply(
-        lambda x: helper.get_time_between_stops(x['stop_sequence'], x['ta'], x['previous_ta'], x['time'], association_df),
-                                                                                                                 axis=1)
-    print('Way to go 3. Since last observation we took ', time.time() - now)
-    now = time.time()
-
-    association_df.dropna(subset=['time_between_stops'], inplace=True)
-
-    association_df.set_index(['ta'], inplace=True)
-    association_df = association_df[association_df['time_between_stops'] < 10]
-
-    agg = association_df.groupby([association_df.index.hour, association_df.index.day_name()]).mean()
-
-    days = ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday']
-    agg = agg.reindex(days, level=1)
-
-    agg.index.names = ['hour', 'weekday']
-    agg = agg.reset_index()
-
-    agg['hour'] = agg['hour'].apply(lambda x: str(x).zfill(2) + ':' + '00')
+    import plotly.express as px
+
+    agg, first_stop, second_stop = historical_by_hour(route, stop_id_1, stop_id_2)
 
     filtered = agg[agg['hour'] == hour]
 
-    print('Now generating graph. Took ', time.time() - now)
+    with metrics.stage('figure'):
+        fig = px.bar(filtered, x='weekday', y='time_between_stops', title=f'Time it takes from '
+                                                                          f'{first_stop} and {second_stop}')
+
+    return fig
+
+
+@metrics.timed('query')
+@cached('travel_matrix', catalog.database_version)
+def travel_time_matrix(route):
+    """Computes the median and 90th percentile time between every pair of stops of a route, per direction, weekday
+    and hour of departure (see segments.route_travel_time_matrix).
+
+    Costs about as much as historical_by_hour does for a single pair. Returns the matrix and the ordered stops of
+    each direction.
+    """
 
-    fig = px.bar(filtered, x='weekday', y='time_between_stops', title=f'Time it takes from '
-                                                                      f'{first_stop} and {second_stop}')
+    with db.connect() as connection:
+        with metrics.stage('compute'):
+            matrix, stops = segments.route_travel_time_matrix(connection, route)
+    metrics.rows(len(matrix))
+
+    return matrix, stops
+
+
+@metrics.timed('query')
+def travel_time_matrix_figure(matrix, stops, weekday, hour):
+    """Creates the heatmap of the median time between every pair of stops at a weekday and hour, for the direction
+    of the route with the most observations then."""
+
+    import plotly.graph_objects as go
+
+    cells = matrix[(matrix['weekday'] == weekday) & (matrix['hour'] == hour)]
+    if cells.empty:
+        return go.Figure()
+
+    with metrics.stage('figure'):
+        direction_id = cells.groupby('direction_id')['observations'].sum().idxmax()
+        cells = cells[cells['direction_id'] == direction_id]
+        stops = stops[stops['direction_id'] == direction_id].drop_duplicates('stop_sequence')
+
+        # Stops are numbered so a name served twice along the direction keeps two rows.
+        names = (stops['stop_sequence'].astype(str) + '. ' + stops['stop_name']).tolist()
+        median = cells.pivot(index='from_sequence', columns='to_sequence', values='p50')
+        median = median.reindex(index=stops['stop_sequence'], columns=stops['stop_sequence'])
+
+        fig = go.Figure(go.Heatmap(z=median.to_numpy(), x=names, y=names, colorscale='Viridis',
+                                   colorbar=dict(title='Minutes'),
+                                   hovertemplate='%{y} to %{x}: %{z:.1f} min<extra></extra>'))
+        fig.update_layout(title=f'Median Time Between Stops, {weekday} at {hour}', xaxis_title='To',
+                          yaxis_title='From', yaxis=dict(autorange='reversed'))
 
     return fig
+
+
+@metrics.timed('query')
+@cached('travel_time', catalog.database_version)
+def segment_travel_time(route, stop_id_1, stop_id_2, hour):
+    """Adds up the precomputed segment times between two stops (see segments.travel_time)."""
+
+    with db.connect() as connection:
+        with metrics.stage('sql'):
+            return segments.travel_time(connection, route, stop_id_1, stop_id_2, hour)
+
+
+@metrics.timed('query')
+def travel_time_data(route, stop_id_1, stop_id_2, hour):
+    """Gets the time between two stops per weekday, with the names of the stops in travel order.
+
+    Reads the precomputed segment_times table and falls back to computing it from the raw positions when the route's
+    segments have not been built yet. Returns plain data so it can run in a background worker.
+    """
+
+    times, first_stop, second_stop = segment_travel_time(route, stop_id_1, stop_id_2, hour)
+
+    if times is None:
+        agg, first_stop, second_stop = historical_by_hour(route, stop_id_1, stop_id_2)
+        times = agg[agg['hour'] == hour]
+
+    return times, first_stop, second_stop
+
+
+@metrics.timed('query')
+def travel_time_figure(times, first_stop, second_stop):
+    """Creates the bar chart of the time between two stops per weekday."""
+
+    import plotly.express as px
+
+    with metrics.stage('figure'):
+        fig = px.bar(times, x='weekday', y='time_between_stops', title=f'Time it takes from '
+                                                                       f'{first_stop} and {second_stop}')
+
+    return fig
+
+
+@metrics.timed('query')
+def travel_time(route, stop_id_1, stop_id_2, hour):
+    """Gets the bar chart of the time between two stops (see travel_time_data)."""
+
+    return travel_time_figure(*travel_time_data(route, stop_id_1, stop_id_2, hour))
@@ -0,0 +1,209 @@
+from sqlalchemy import text
+
+
+# Travel time between consecutive stops of a route, bucketed by weekday and hour. The time of a segment is stored as
+# a sum and a number of observations so it can be averaged and updated in place.
+SEGMENT_TIMES = """
+                CREATE TABLE IF NOT EXISTS segment_times (
+                    route_id TEXT NOT NULL,
+                    direction_id INTEGER NOT NULL,
+                    stop_sequence INTEGER NOT NULL,
+                    stop_id INTEGER NOT NULL,
+                    weekday TEXT NOT NULL,
+                    hour TEXT NOT NULL,
+                    total_minutes REAL NOT NULL,
+                    observations INTEGER NOT NULL,
+                    PRIMARY KEY (route_id, direction_id, stop_sequence, stop_id, weekday, hour)
+                );
+                """
+
+# GTFS route_id -> SPTrans API line codes. api_routes.c holds the route code and cl the line code that bus_position
+# refers to, one per direction.
+ROUTE_MAP = """
+            CREATE TABLE IF NOT EXISTS route_map (
+                route_id TEXT NOT NULL,
+                c TEXT NOT NULL,
+                cl INTEGER NOT NULL,
+                PRIMARY KEY (route_id, cl)
+            );
+            """
+
+# GTFS route_id -> values of passengers.routes that mention it.
+PASSENGER_ROUTES = """
+                   CREATE TABLE IF NOT EXISTS passenger_routes (
+                       route_id TEXT NOT NULL,
+                       routes TEXT NOT NULL,
+                       PRIMARY KEY (route_id, routes)
+                   );
+                   """
+
+# Canonical ordered stop list of each direction of a route, taken from the direction's trip with the most stops.
+ROUTE_STOPS = """
+              CREATE TABLE IF NOT EXISTS route_stops (
+                  route_id TEXT NOT NULL,
+                  direction_id INTEGER NOT NULL,
+                  stop_sequence INTEGER NOT NULL,
+                  stop_id INTEGER NOT NULL,
+                  stop_name TEXT,
+                  stop_lat REAL NOT NULL,
+                  stop_lon REAL NOT NULL,
+                  PRIMARY KEY (route_id, direction_id, stop_sequence)
+              );
+              """
+
+# Latest fixes of each vehicle seen by the incremental ingestion. The newest one is the vehicle's watermark; the
+# others let crossings right after it be paired with the stop crossed just before.
+INGEST_TAIL = """
+              CREATE TABLE IF NOT EXISTS ingest_tail (
+                  p INTEGER NOT NULL,
+                  ta TEXT NOT NULL,
+                  cl INTEGER NOT NULL,
+                  id INTEGER,
+                  py REAL NOT NULL,
+                  px REAL NOT NULL,
+                  PRIMARY KEY (p, ta)
+              );
+              """
+
+# Passengers of a route per weekday and quarter (period = 'quarter') or month (period = 'month'), stored as a sum and a
+# number of daily counts so the average can be read directly.
+PASSENGER_STATS = """
+                  CREATE TABLE IF NOT EXISTS passenger_stats (
+                      route_id TEXT NOT NULL,
+                      period TEXT NOT NULL,
+                      period_value INTEGER NOT NULL,
+                      weekday TEXT NOT NULL,
+                      total_passengers REAL NOT NULL,
+                      observations INTEGER NOT NULL,
+                      PRIMARY KEY (route_id, period, period_value, weekday)
+                  );
+                  """
+
+# Rows of passengers already aggregated into passenger_stats, per passengers.routes value. Values whose count or last
+# date changed have new data and their routes must be refreshed.
+PASSENGER_LOADS = """
+                  CREATE TABLE IF NOT EXISTS passenger_loads (
+                      routes TEXT NOT NULL,
+                      observations INTEGER NOT NULL,
+                      last_date TEXT,
+                      PRIMARY KEY (routes)
+                  );
+                  """
+
+TABLES = [SEGMENT_TIMES, ROUTE_MAP, PASSENGER_ROUTES, ROUTE_STOPS, INGEST_TAIL, PASSENGER_STATS, PASSENGER_LOADS]
+
+# Indexes the route lookups of utils/queries.py rely on. Positions are looked up by line, and read by line, vehicle
+# and time (segments.route_position_chunks).
+INDEXES = ["""CREATE INDEX IF NOT EXISTS trips_route_id ON trips (route_id);""",
+           """CREATE INDEX IF NOT EXISTS stop_times_trip_id ON stop_times (trip_id);""",
+           """CREATE INDEX IF NOT EXISTS shapes_shape_id ON shapes (shape_id);""",
+           """CREATE INDEX IF NOT EXISTS bus_position_cl_p_ta ON bus_position (cl, p, ta);""",
+           """CREATE INDEX IF NOT EXISTS passengers_routes ON passengers (routes);"""]
+
+# The route codes used to be matched with LIKE '%route%' on every query. The same match is now done once, here.
+ROUTE_MAP_ROWS = """
+                 INSERT INTO route_map (route_id, c, cl)
+                 SELECT routes.route_id, api_routes.c, api_routes.cl
+                 FROM routes
+                 JOIN api_routes ON api_routes.c LIKE '%' || routes.route_id || '%'
+                 WHERE true
+                 ON CONFLICT DO NOTHING;
+                 """
+
+PASSENGER_ROUTES_ROWS = """
+                        INSERT INTO passenger_routes (route_id, routes)
+                        SELECT routes.route_id, A.routes
+                        FROM (SELECT DISTINCT routes FROM passengers) AS A
+                        JOIN routes ON A.routes LIKE '%' || routes.route_id || '%'
+                        WHERE true
+                        ON CONFLICT DO NOTHING;
+                        """
+
+ROUTE_STOPS_ROWS = """
+                   WITH counts AS (SELECT trips.route_id, trips.direction_id, trips.trip_id, COUNT(*) AS stops
+                   FROM trips
+                   JOIN stop_times ON stop_times.trip_id = trips.trip_id
+                   GROUP BY trips.route_id, trips.direction_id, trips.trip_id)
+                   INSERT INTO route_stops (route_id, direction_id, stop_sequence, stop_id, stop_name, stop_lat,
+                                            stop_lon)
+                   SELECT A.route_id, A.direction_id, stop_times.stop_sequence, stops.stop_id, stop_name, stop_lat,
+                   stop_lon
+                   FROM (SELECT route_id, direction_id, trip_id
+                   FROM counts
+                   WHERE NOT EXISTS (SELECT 1 FROM counts AS B
+                   WHERE B.route_id = counts.route_id AND B.direction_id = counts.direction_id
+                   AND (B.stops > counts.stops OR (B.stops = counts.stops AND B.trip_id < counts.trip_id)))) AS A
+                   JOIN stop_times ON stop_times.trip_id = A.trip_id
+                   JOIN stops ON stops.stop_id = stop_times.stop_id
+                   WHERE true
+                   ON CONFLICT DO NOTHING;
+                   """
+
+
+ADD_SEGMENT_TIMES = """
+                    INSERT INTO segment_times (route_id, direction_id, stop_sequence, stop_id, weekday, hour,
+                                               total_minutes, observations)
+                    VALUES (:route_id, :direction_id, :stop_sequence, :stop_id, :weekday, :hour, :total_minutes,
+                            :observations)
+                    ON CONFLICT (route_id, direction_id, stop_sequence, stop_id, weekday, hour) DO UPDATE
+                    SET total_minutes = segment_times.total_minutes + excluded.total_minutes,
+                    observations = segment_times.observations + excluded.observations;
+                    """
+
+
+def create_tables(connection):
+    """Creates the derived tables the app reads from. Safe to run more than once."""
+
+    for statement in TABLES:
+        connection.execute(text(statement))
+
+
+def create_indexes(connection):
+    """Creates the indexes used by the route lookups. Safe to run more than once."""
+
+    for statement in INDEXES:
+        connection.execute(text(statement))
+
+
+def build_route_maps(connection, rebuild=False):
+    """Fills the route mapping and route stop tables. Unless rebuild is set, tables that already have rows are left
+    untouched."""
+
+    for table, statement in [('route_map', ROUTE_MAP_ROWS), ('passenger_routes', PASSENGER_ROUTES_ROWS),
+                             ('route_stops', ROUTE_STOPS_ROWS)]:
+        with connection.begin():
+            if rebuild:
+                connection.execute(text(f"""DELETE FROM {table}"""))
+
+            if connection.execute(text(f"""SELECT 1 FROM {table} LIMIT 1""")).first() is None:
+                connection.execute(text(statement))
+
+
+def prepare(connection):
+    """Makes sure every derived table, index and route mapping exists."""
+
+    create_tables(connection)
+    create_indexes(connection)
+    build_route_maps(connection)
+
+
+def insert_rows(connection, table, frame):
+    """Appends the rows of a data frame to a table whose columns match the data frame's. Column names are quoted, so
+    reserved words such as index can be used."""
+
+    if frame.empty:
+        return
+
+    columns = list(frame.columns)
+    statement = text(f"""INSERT INTO {table} ({', '.join('"' + column + '"' for column in columns)})
+                         VALUES ({', '.join(':' + column for column in columns)})""")
+
+    # Object dtype turns numpy scalars into plain Python values the database driver can bind.
+    connection.execute(statement, frame.astype(object).to_dict('records'))
+
+
+def add_segment_times(connection, frame):
+    """Adds the sums and observation counts of a segment_times-shaped data frame to the stored ones."""
+
+    if not frame.empty:
+        connection.execute(text(ADD_SEGMENT_TIMES), frame.astype(object).to_dict('records'))
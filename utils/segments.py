@@ -0,0 +1,496 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import os
+import time
+
+from sqlalchemy import bindparam, text
+import numpy as np
+import pandas as pd
+
+from utils import config, crossings, linref, position_store, schema
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python 3.7 has no shared memory, so everything runs in the calling process.
+    shared_memory = None
+
+
+# Fixes of each vehicle carried over from one chunk of positions to the next (see stream_route_positions).
+CONTEXT_FIXES = 200
+
+# Columns of the positions handed to the workers of a parallel computation, and their types in shared memory. Times
+# are shared as nanoseconds since epoch (UTC).
+SHARED_COLUMNS = {'id': np.int64, 'p': np.int64, 'ta': 'datetime64[ns]', 'py': np.float64, 'px': np.float64}
+
+_pool = None
+_pool_key = None
+
+
+def route_stop_sequence(connection, route):
+    """Gets the ordered stops of each direction of a route."""
+
+    query = text("""SELECT direction_id, stop_sequence, stop_id, stop_name, stop_lat, stop_lon
+                    FROM route_stops
+                    WHERE route_id = :bus_route
+                    ORDER BY direction_id, stop_sequence;""")
+    result = connection.execute(query, bus_route=route)
+
+    return pd.DataFrame(result.fetchall(), columns=result.keys())
+
+
+def route_shapes(connection, route):
+    """Gets the shape points of each direction of a route, one shape per direction."""
+
+    query = text("""SELECT A.direction_id, shapes.shape_id, shape_pt_lat, shape_pt_lon, shape_pt_sequence
+                    FROM (SELECT direction_id, MIN(shape_id) AS shape_id
+                    FROM trips
+                    WHERE route_id = :bus_route
+                    GROUP BY direction_id) AS A
+                    JOIN shapes ON A.shape_id = shapes.shape_id
+                    ORDER BY A.direction_id, shape_pt_sequence;""")
+    result = connection.execute(query, bus_route=route)
+
+    return pd.DataFrame(result.fetchall(), columns=result.keys())
+
+
+def route_positions(connection, route):
+    """Gets every recorded position of the buses serving a route, in São Paulo time.
+
+    Routes exported to the columnar position store are read from it instead of the database.
+    """
+
+    if position_store.has_route(route):
+        return position_store.load_positions(route)
+
+    query = text("""
+                 SELECT route_map.c, id, p, ta, py, px
+                 FROM route_map
+                 INNER JOIN bus_position ON route_map.cl = bus_position.cl
+                 WHERE route_map.route_id = :bus_route;
+                 """)
+    result = connection.execute(query, bus_route=route)
+
+    positions = pd.DataFrame(result.fetchall(), columns=result.keys())
+    positions['ta'] = pd.to_datetime(positions['ta'], utc=True).dt.tz_convert('America/Sao_Paulo')
+
+    return positions
+
+
+def _vehicle_batches(connection, route, chunk_size):
+    # Vehicles of a route, in groups of whole vehicles with up to chunk_size positions (or one vehicle with more). The
+    # counts are read from the (cl, p, ta) index of bus_position.
+    query = text("""
+                 SELECT p, COUNT(*) AS positions
+                 FROM route_map
+                 INNER JOIN bus_position ON route_map.cl = bus_position.cl
+                 WHERE route_map.route_id = :bus_route
+                 GROUP BY p
+                 ORDER BY p;
+                 """)
+    batches, batch, size = [], [], 0
+    for vehicle, positions in connection.execute(query, bus_route=route):
+        if batch and size + positions > chunk_size:
+            batches.append(batch)
+            batch, size = [], 0
+        batch.append(vehicle)
+        size += positions
+
+    return batches + [batch] if batch else batches
+
+
+def route_position_chunks(connection, route, chunk_size):
+    """Yields the positions of a route like route_positions, in chunks of at most chunk_size rows.
+
+    Rows come ordered by vehicle and time from the database, and by time from the columnar position store. Only one
+    chunk is held in memory at a time. The database is read a batch of vehicles at a time, so it never sorts more
+    than a chunk's worth of positions (or the positions of a vehicle with more than that).
+    """
+
+    if position_store.has_route(route):
+        yield from position_store.iter_positions(route, chunk_size)
+        return
+
+    query = text("""
+                 SELECT route_map.c, id, p, ta, py, px
+                 FROM route_map
+                 INNER JOIN bus_position ON route_map.cl = bus_position.cl
+                 WHERE route_map.route_id = :bus_route AND p IN :vehicles
+                 ORDER BY p, ta;
+                 """)
+    query = query.bindparams(bindparam('vehicles', expanding=True))
+
+    for vehicles in _vehicle_batches(connection, route, chunk_size):
+        result = connection.execution_options(stream_results=True).execute(query, bus_route=route,
+                                                                            vehicles=vehicles)
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+
+            positions = pd.DataFrame(rows, columns=result.keys())
+            positions['ta'] = pd.to_datetime(positions['ta'], utc=True).dt.tz_convert('America/Sao_Paulo')
+
+            yield positions
+
+
+def stream_route_positions(connection, route, chunk_size=None, context=CONTEXT_FIXES):
+    """Yields the positions of a route one chunk at a time, each with the last carried fix time of every vehicle.
+
+    Memory is bounded by the chunk size (BUS_APP_CHUNK_SIZE positions by default) however much history the route
+    has; 0 reads every position at once. The last context fixes of every vehicle are carried into the next chunk so
+    the previous fix, the position along the shape and the previous stop crossed are known across the boundary (see
+    chunk_crossings). Results match processing the route at once unless a trip crosses a chunk boundary more than
+    context fixes after it started.
+    """
+
+    chunk_size = config.CHUNK_SIZE if chunk_size is None else chunk_size
+    if not chunk_size:
+        positions = route_positions(connection, route)
+        if not positions.empty:
+            yield positions, None
+        return
+
+    tail = None
+    for chunk in route_position_chunks(connection, route, chunk_size):
+        positions = chunk if tail is None else pd.concat([tail, chunk[tail.columns]], ignore_index=True)
+        carried_until = None if tail is None else tail.groupby('p')['ta'].max()
+
+        yield positions, carried_until
+
+        # Vehicles missing from this chunk have finished (rows come by vehicle) or are off for the day.
+        positions = positions[positions['p'].isin(chunk['p'].unique())].sort_values(['p', 'ta'], kind='mergesort')
+        tail = positions.groupby('p').tail(context).reset_index(drop=True)
+
+
+def chunk_crossings(positions, carried_until, sequence, shapes):
+    """Detects and pairs the stop crossings of a chunk of positions (see stream_route_positions).
+
+    Crossings up to the last carried fix of a vehicle belong to the previous chunk and are left out.
+    """
+
+    stop_crossings = route_crossings(crossings.add_previous_fix(positions), sequence, shapes)
+
+    if carried_until is not None:
+        seen = stop_crossings['ta'] <= stop_crossings['p'].map(carried_until)
+        stop_crossings = stop_crossings[~seen.fillna(False).to_numpy(dtype=bool)]
+
+    return stop_crossings
+
+
+def route_partials(connection, route, sequence, shapes, aggregate, chunk_size=None, workers=None):
+    """Aggregates the stop crossings of a route chunk by chunk (see stream_route_positions).
+
+    aggregate takes the crossings of a chunk and returns partial sums, which the caller adds up with
+    crossings.merge_partials. With more than one worker (BUS_APP_COMPUTE_WORKERS by default) every chunk is split by
+    vehicle across a process pool (see _parallel_partials); otherwise, or if that fails, chunks are processed here.
+    So are they in a process started by multiprocessing, such as a worker of the job queue's process pool: its own
+    pool would multiply the processes and keep it from exiting.
+    """
+
+    workers = config.COMPUTE_WORKERS if workers is None else workers
+    if shared_memory is None or multiprocessing.parent_process() is not None:
+        workers = 1
+
+    partials = []
+    for positions, carried_until in stream_route_positions(connection, route, chunk_size):
+        if workers > 1 and positions['p'].nunique() > 1:
+            try:
+                partials += _parallel_partials(positions, carried_until, sequence, shapes, aggregate, workers)
+                continue
+            except (OSError, BrokenProcessPool) as error:
+                print('Could not split the computation across processes, running it serially: ', error)
+
+        partials.append(aggregate(chunk_crossings(positions, carried_until, sequence, shapes)))
+
+    return partials
+
+
+def _vehicle_ranges(vehicles, parts):
+    # Cuts rows sorted by vehicle into up to parts ranges of about the same size, never splitting a vehicle.
+    starts = np.flatnonzero(np.concatenate([[True], vehicles[1:] != vehicles[:-1]]))
+    targets = np.arange(1, parts) * len(vehicles) // parts
+    cuts = starts[np.minimum(np.searchsorted(starts, targets), len(starts) - 1)]
+    bounds = np.unique(np.concatenate([[0], cuts, [len(vehicles)]]))
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _get_pool(workers):
+    # Pools are not shared across fork, and are replaced when the worker count changes. A replaced pool of this
+    # process is shut down so its worker processes exit; one inherited through fork belongs to the parent.
+    global _pool, _pool_key
+
+    if _pool is None or _pool_key != (os.getpid(), workers):
+        if _pool is not None and _pool_key[0] == os.getpid():
+            _pool.shutdown(wait=False)
+
+        _pool = ProcessPoolExecutor(workers)
+        _pool_key = (os.getpid(), workers)
+
+    return _pool
+
+
+def _parallel_partials(positions, carried_until, sequence, shapes, aggregate, workers):
+    # The columns are copied once into shared memory, sorted by vehicle, and every worker copies its own range of
+    # vehicles out of there instead of receiving a pickled copy of the chunk.
+    positions = positions.sort_values(['p', 'ta'], kind='mergesort', ignore_index=True)
+    columns = {column: positions[column].to_numpy(dtype=dtype) for column, dtype in SHARED_COLUMNS.items()}
+
+    blocks = {}
+    try:
+        for column, values in columns.items():
+            blocks[column] = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+            np.ndarray(values.shape, values.dtype, buffer=blocks[column].buf)[:] = values
+        layout = {column: (blocks[column].name, values.shape, values.dtype.str) for column, values in columns.items()}
+
+        futures = []
+        for start, end in _vehicle_ranges(columns['p'], workers):
+            futures.append(_get_pool(workers).submit(_partition_partial, layout, start, end, carried_until, sequence,
+                                                     shapes, aggregate))
+
+        return [future.result() for future in futures]
+    finally:
+        for block in blocks.values():
+            block.close()
+            block.unlink()
+
+
+def _partition_partial(layout, start, end, carried_until, sequence, shapes, aggregate):
+    # Runs in a pool worker: copies its rows of the positions out of shared memory, which is closed right after, and
+    # aggregates their crossings.
+    blocks = {column: shared_memory.SharedMemory(name=name) for column, (name, _, _) in layout.items()}
+    try:
+        positions = pd.DataFrame({column: np.ndarray(shape, dtype, buffer=blocks[column].buf)[start:end].copy()
+                                  for column, (_, shape, dtype) in layout.items()})
+    finally:
+        for block in blocks.values():
+            block.close()
+
+    positions['ta'] = pd.to_datetime(positions['ta'], utc=True).dt.tz_convert('America/Sao_Paulo')
+
+    return aggregate(chunk_crossings(positions, carried_until, sequence, shapes))
+
+
+def route_crossings(positions, sequence, shapes):
+    """Detects and pairs the stop crossings of each direction of a route.
+
+    Positions must carry their previous fix (crossings.add_previous_fix). Directions with a shape are map matched
+    onto it and paired with the previous stop crossed along the way. Directions without one fall back to the
+    bounding-box engine.
+    """
+
+    # Each direction has its own stop_sequence numbering, so crossings are paired one direction at a time. Buses
+    # running the other way cross the stops in reverse order and never produce a positive time.
+    frames = []
+    for direction_id, stops in sequence.groupby('direction_id'):
+        shape = shapes[shapes['direction_id'] == direction_id]
+
+        if len(shape) > 1:
+            polyline = linref.Polyline(shape['shape_pt_lat'], shape['shape_pt_lon'])
+            stop_crossings = linref.detect_crossings(positions, stops, polyline)
+            stop_crossings = crossings.pair_consecutive_crossings(stop_crossings, stops)
+        else:
+            stop_crossings = crossings.detect_crossings(positions, stops)
+            stop_crossings = crossings.pair_previous_stop(stop_crossings)
+
+        stop_crossings['direction_id'] = direction_id
+        frames.append(stop_crossings)
+
+    if not frames:
+        return pd.DataFrame(columns=['p', 'id', 'ta', 'previous_ta', 'stop_id', 'stop_sequence', 'time',
+                                     'time_between_stops', 'direction_id'])
+
+    return pd.concat(frames, ignore_index=True, sort=False)
+
+
+def direction_segments(stop_crossings):
+    """Sums the time between consecutive stops of each direction (see crossings.aggregate_segments)."""
+
+    frames = []
+    for direction_id, direction_crossings in stop_crossings.groupby('direction_id'):
+        agg = crossings.aggregate_segments(direction_crossings)
+        agg['direction_id'] = direction_id
+        frames.append(agg)
+
+    if not frames:
+        return pd.DataFrame(columns=['direction_id', 'stop_sequence', 'stop_id', 'weekday', 'hour', 'total_minutes',
+                                     'observations'])
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def route_segment_times(connection, route, workers=None):
+    """Computes the travel time between every pair of consecutive stops of a route, per weekday and hour.
+
+    Positions are processed in chunks, optionally across processes (route_partials), whose partial sums are added up
+    at the end.
+    """
+
+    columns = ['route_id', 'direction_id', 'stop_sequence', 'stop_id', 'weekday', 'hour', 'total_minutes',
+               'observations']
+
+    sequence = route_stop_sequence(connection, route)
+    if sequence.empty:
+        return pd.DataFrame(columns=columns)
+
+    partials = route_partials(connection, route, sequence, route_shapes(connection, route), direction_segments,
+                              workers=workers)
+
+    table = crossings.merge_partials(partials, ['direction_id', 'stop_sequence', 'stop_id', 'weekday', 'hour'])
+    table['route_id'] = route
+
+    return table[columns]
+
+
+def matrix_crossings(stop_crossings):
+    """Keeps the columns of paired crossings that crossings.travel_time_matrix needs, to collect them chunk by chunk."""
+
+    return stop_crossings[['p', 'previous_ta', 'time', 'stop_sequence', 'time_between_stops', 'direction_id']]
+
+
+def route_travel_time_matrix(connection, route, percentiles=(50, 90), chunk_size=None, workers=None):
+    """Computes the travel time between every pair of stops of each direction of a route (see
+    crossings.travel_time_matrix), from one pass over the route's positions.
+
+    Percentiles need every observation, so the crossings of all chunks (route_partials) are kept, but only a few
+    columns of them; the positions are read a chunk at a time. Returns the matrix, with the stop ids and the direction,
+    and the ordered stops of each direction.
+    """
+
+    columns = ['direction_id', 'from_sequence', 'from_stop_id', 'to_sequence', 'to_stop_id', 'weekday', 'hour',
+               'observations'] + [f'p{q}' for q in percentiles]
+
+    sequence = route_stop_sequence(connection, route)
+    if sequence.empty:
+        return pd.DataFrame(columns=columns), sequence
+
+    partials = route_partials(connection, route, sequence, route_shapes(connection, route), matrix_crossings,
+                              chunk_size, workers)
+    if not partials:
+        return pd.DataFrame(columns=columns), sequence
+
+    stop_crossings = pd.concat(partials, ignore_index=True)
+
+    frames = []
+    for direction_id, stops in sequence.groupby('direction_id'):
+        matrix = crossings.travel_time_matrix(stop_crossings[stop_crossings['direction_id'] == direction_id], stops,
+                                              percentiles)
+
+        stop_ids = stops.drop_duplicates('stop_sequence').set_index('stop_sequence')['stop_id']
+        matrix['from_stop_id'] = matrix['from_sequence'].map(stop_ids)
+        matrix['to_stop_id'] = matrix['to_sequence'].map(stop_ids)
+        matrix['direction_id'] = direction_id
+        frames.append(matrix[columns])
+
+    return pd.concat(frames, ignore_index=True), sequence
+
+
+def build_segment_times(connection, routes=None, workers=None):
+    """Rebuilds the segment_times rows of the given routes (all routes by default)."""
+
+    schema.prepare(connection)
+
+    if routes is None:
+        routes = [row[0] for row in connection.execute(text("""SELECT route_id FROM routes"""))]
+
+    for route in routes:
+        now = time.time()
+        table = route_segment_times(connection, route, workers)
+
+        with connection.begin():
+            connection.execute(text("""DELETE FROM segment_times WHERE route_id = :route_id"""), route_id=route)
+            schema.insert_rows(connection, 'segment_times', table)
+
+        print(f'{route}: {len(table)} segment rows in {time.time() - now:.1f}s')
+
+
+def stop_pair(sequence, stop_id_1, stop_id_2):
+    """Finds a direction of a route in which both stops are served, preferring one where the first stop comes first.
+
+    Takes the ordered stops of the route (route_stop_sequence). Returns the direction, the stop_sequence of the two
+    stops in travel order and their names in that order, or None if no direction serves both stops.
+    """
+
+    first = sequence[sequence['stop_id'] == stop_id_1]
+    second = sequence[sequence['stop_id'] == stop_id_2]
+    pairs = first.merge(second, on='direction_id', suffixes=('_1', '_2'))
+
+    if pairs.empty:
+        return None
+
+    pairs['backwards'] = pairs['stop_sequence_1'] > pairs['stop_sequence_2']
+    pair = pairs.sort_values('backwards', kind='mergesort').iloc[0]
+
+    if pair['backwards']:
+        return (int(pair['direction_id']), int(pair['stop_sequence_2']), int(pair['stop_sequence_1']),
+                pair['stop_name_2'], pair['stop_name_1'])
+
+    return (int(pair['direction_id']), int(pair['stop_sequence_1']), int(pair['stop_sequence_2']), pair['stop_name_1'],
+            pair['stop_name_2'])
+
+
+def count_segments(sequence, direction_id, start, end):
+    """Counts the segments between two stops of a direction, given by their stop_sequence. GTFS numbers stops in
+    increasing order but not always without gaps, so they are counted from the stop list."""
+
+    stops = sequence[(sequence['direction_id'] == direction_id) & (sequence['stop_sequence'] > start) &
+                     (sequence['stop_sequence'] <= end)]
+
+    return int(stops['stop_sequence'].nunique())
+
+
+def add_up_segments(table, start, segments):
+    """Adds up the average segment times of segment_times rows per weekday and hour, like travel_time does in SQL.
+
+    Takes the rows of one direction up to the last stop. Only weekday and hour combinations in which every one of the
+    segments after the start stop has observations are kept.
+    """
+
+    table = table[table['stop_sequence'] > start]
+    table = table.assign(time_between_stops=table['total_minutes'] / table['observations'])
+
+    agg = table.groupby(['hour', 'weekday']).agg(time_between_stops=('time_between_stops', 'sum'),
+                                                 segments=('stop_sequence', 'nunique')).reset_index()
+    agg = agg[agg['segments'] == segments]
+
+    agg['weekday'] = pd.Categorical(agg['weekday'], categories=crossings.DAYS, ordered=True)
+    agg.sort_values(['hour', 'weekday'], ignore_index=True, inplace=True)
+
+    return agg[['hour', 'weekday', 'time_between_stops']]
+
+
+def travel_time(connection, route, stop_id_1, stop_id_2, hour):
+    """Adds up the average segment times between two stops of a route, per weekday, for one hour of the day.
+
+    Returns the data frame and the names of the stops in travel order. The data frame is None if the route has no
+    precomputed segments.
+    """
+
+    query = text("""SELECT 1 FROM segment_times WHERE route_id = :route_id LIMIT 1""")
+    if connection.execute(query, route_id=route).first() is None:
+        return None, None, None
+
+    sequence = route_stop_sequence(connection, route)
+    pair = stop_pair(sequence, stop_id_1, stop_id_2)
+    if pair is None:
+        return pd.DataFrame(columns=['weekday', 'time_between_stops']), None, None
+
+    direction_id, start, end, first_stop, second_stop = pair
+
+    # A weekday only counts when every segment between the two stops has observations at that hour.
+    query = text("""SELECT weekday, SUM(total_minutes / observations) AS time_between_stops
+                    FROM segment_times
+                    WHERE route_id = :route_id AND direction_id = :direction_id AND hour = :hour
+                    AND stop_sequence > :start AND stop_sequence <= :end
+                    GROUP BY weekday
+                    HAVING COUNT(DISTINCT stop_sequence) = :segments;""")
+    result = connection.execute(query, route_id=route, direction_id=direction_id, hour=hour, start=start, end=end,
+                                segments=count_segments(sequence, direction_id, start, end))
+
+    times = pd.DataFrame(result.fetchall(), columns=result.keys())
+    times['weekday'] = pd.Categorical(times['weekday'], categories=crossings.DAYS, ordered=True)
+    times.sort_values('weekday', ignore_index=True, inplace=True)
+
+    return times, first_stop, second_stop
@@ -0,0 +1,258 @@
+"""Synthetic bus.db with the tables and columns of the Kaggle-derived database, at a configurable scale.
+
+Routes are random walks around central São Paulo, served in both directions by vehicles that shuttle between the
+two terminals all day. Their speed depends on the hour and the weekday and varies from one stop to the next, they
+dwell at every stop and their fixes carry a few metres of GPS noise, so travel times look like real ones. The same
+seed always gives the same database.
+"""
+import time
+
+from sqlalchemy import text
+import numpy as np
+import pandas as pd
+
+from utils import linref, schema
+
+
+CENTER = (-23.5507, -46.6334)
+
+# São Paulo time, in which service hours and speeds are given, is UTC-3.
+UTC_OFFSET = -3 * 3600
+
+# Bus speed in km/h per hour of the day, slower at the morning and evening peaks. Weekends run WEEKEND_SPEEDUP
+# times faster.
+SPEEDS = [24, 24, 24, 24, 23, 21, 18, 14, 13, 16, 19, 19, 18, 18, 19, 18, 16, 13, 12, 15, 19, 21, 22, 23]
+WEEKEND_SPEEDUP = 1.2
+
+# Source tables, with the columns of the original database (see flows/bus.db ERD copy.png).
+TABLES = {
+    'routes': """CREATE TABLE routes ("index" INTEGER, route_id TEXT, agency_id INTEGER, route_short_name TEXT,
+                 route_long_name TEXT, route_type INTEGER, route_color TEXT, route_text_color TEXT)""",
+    'trips': """CREATE TABLE trips ("index" INTEGER, route_id TEXT, service_id TEXT, trip_id TEXT, trip_headsign TEXT,
+                direction_id INTEGER, shape_id INTEGER)""",
+    'stops': """CREATE TABLE stops ("index" INTEGER, stop_id INTEGER, stop_name TEXT, stop_desc TEXT, stop_lat REAL,
+                stop_lon REAL)""",
+    'stop_times': """CREATE TABLE stop_times ("index" INTEGER, trip_id TEXT, arrival_time TEXT, departure_time TEXT,
+                     stop_id INTEGER, stop_sequence INTEGER)""",
+    'shapes': """CREATE TABLE shapes ("index" INTEGER, shape_id INTEGER, shape_pt_lat REAL, shape_pt_lon REAL,
+                 shape_pt_sequence INTEGER, shape_dist_traveled REAL)""",
+    'api_routes': """CREATE TABLE api_routes ("index" INTEGER, cl INTEGER, lc BOOLEAN, lt TEXT, sl INTEGER, tl INTEGER,
+                     tp TEXT, ts TEXT, c TEXT)""",
+    'bus_position': """CREATE TABLE bus_position ("index" INTEGER, hr TEXT, c TEXT, cl INTEGER, lt0 TEXT, lt1 TEXT,
+                       qv INTEGER, p INTEGER, a BOOLEAN, ta TEXT, py REAL, px REAL, id INTEGER)""",
+    'passengers': """CREATE TABLE passengers ("index" INTEGER, date TEXT, type TEXT, area TEXT, company TEXT,
+                     routes TEXT, name TEXT, passengers REAL)"""
+}
+
+
+def _to_degrees(x, y):
+    lat = CENTER[0] + np.degrees(y / linref.EARTH_RADIUS)
+    lon = CENTER[1] + np.degrees(x / (linref.EARTH_RADIUS * np.cos(np.radians(CENTER[0]))))
+
+    return lat, lon
+
+
+def route_path(rng, points=120, spacing=100, radius=8000):
+    """Draws a route as a random walk of points metres apart, starting somewhere within radius of the centre.
+
+    Returns the coordinates and the distance travelled at each point.
+    """
+
+    start = rng.uniform(-radius, radius, 2)
+    heading = rng.uniform(0, 2 * np.pi) + np.cumsum(rng.normal(0, 0.25, points - 1))
+
+    x = start[0] + np.concatenate([[0], np.cumsum(spacing * np.cos(heading))])
+    y = start[1] + np.concatenate([[0], np.cumsum(spacing * np.sin(heading))])
+    lat, lon = _to_degrees(x, y)
+
+    return lat, lon, np.arange(points) * float(spacing)
+
+
+def _clock(seconds):
+    seconds = int(seconds)
+    return f'{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+
+
+def trip_fixes(rng, stop_distance, length, start, interval=30, dwell=20, weekend=False):
+    """Samples the distance travelled by a bus every interval seconds along one trip.
+
+    The bus leaves at start (seconds since epoch), drives from stop to stop at the speed of the hour with some
+    noise and waits dwell seconds (on average) at each stop. Returns the fix times and distances, and the arrival.
+    """
+
+    knots = np.concatenate([[0], stop_distance, [length]])
+    hour = int((start + UTC_OFFSET) % 86400 // 3600)
+    speed = SPEEDS[hour] * (WEEKEND_SPEEDUP if weekend else 1) / 3.6 * rng.lognormal(0, 0.25, len(knots) - 1)
+
+    # Every stop adds a second knot at the same distance, dwell seconds later.
+    driving = np.diff(knots) / speed
+    waiting = rng.exponential(dwell, len(knots) - 1)
+    times = start + np.concatenate([[0], np.cumsum(np.column_stack([driving, waiting]).ravel())])
+    distances = np.repeat(knots, 2)[1:]
+
+    fix_times = np.arange(start + rng.uniform(0, interval), times[-1], interval)
+    fix_times = fix_times + rng.uniform(-3, 3, len(fix_times))
+
+    return fix_times, np.interp(fix_times, times, distances), times[-1]
+
+
+def route_tables(rng, number, stops_per_route=30, trips_per_direction=10, points=120, spacing=100):
+    """Builds the GTFS and API rows of one route, both directions sharing the same stops."""
+
+    route_id = f'{1000 + number}-10'
+    long_name = f'Terminal {number} - Centro'
+
+    lat, lon, distance = route_path(rng, points, spacing)
+    stop_distance = np.sort(rng.uniform(0, distance[-1], stops_per_route))
+    stops = pd.DataFrame({'stop_id': 100000 + number * 1000 + np.arange(stops_per_route),
+                          'stop_name': [f'Rua {number}-{k}' for k in range(stops_per_route)],
+                          'stop_desc': '',
+                          'stop_lat': np.interp(stop_distance, distance, lat),
+                          'stop_lon': np.interp(stop_distance, distance, lon)})
+
+    route = pd.DataFrame({'route_id': [route_id], 'agency_id': 1, 'route_short_name': route_id,
+                          'route_long_name': long_name, 'route_type': 3,
+                          'route_color': ''.join(rng.choice(list('0123456789ABCDEF'), 6)),
+                          'route_text_color': 'FFFFFF'})
+
+    trips, stop_times, shapes, api_routes = [], [], [], []
+    for direction_id in [0, 1]:
+        shape_id = 2 * number + direction_id + 1
+        order = slice(None) if direction_id == 0 else slice(None, None, -1)
+
+        shapes.append(pd.DataFrame({'shape_id': shape_id, 'shape_pt_lat': lat[order], 'shape_pt_lon': lon[order],
+                                    'shape_pt_sequence': np.arange(1, points + 1), 'shape_dist_traveled': distance}))
+
+        # SPTrans numbers the line of the second direction 32768 above the first one.
+        api_routes.append({'cl': 1000 + number + 32768 * direction_id, 'lc': False, 'lt': str(1000 + number),
+                           'sl': direction_id + 1, 'tl': 10, 'tp': 'Centro', 'ts': f'Terminal {number}',
+                           'c': route_id})
+
+        served = stops['stop_id'].to_numpy()[order]
+        scheduled = (stop_distance if direction_id == 0 else distance[-1] - stop_distance[::-1]) / (18 / 3.6)
+        for trip in range(trips_per_direction):
+            trip_id = f'{route_id}-{direction_id}-{trip}'
+            trips.append({'route_id': route_id, 'service_id': 'USD', 'trip_id': trip_id,
+                          'trip_headsign': long_name.split(' - ')[1 - direction_id], 'direction_id': direction_id,
+                          'shape_id': shape_id})
+
+            clock = [_clock(5 * 3600 + trip * 1800 + seconds) for seconds in scheduled]
+            stop_times.append(pd.DataFrame({'trip_id': trip_id, 'arrival_time': clock, 'departure_time': clock,
+                                            'stop_id': served, 'stop_sequence': np.arange(1, stops_per_route + 1)}))
+
+    return {'routes': route, 'trips': pd.DataFrame(trips), 'stops': stops,
+            'stop_times': pd.concat(stop_times, ignore_index=True), 'shapes': pd.concat(shapes, ignore_index=True),
+            'api_routes': pd.DataFrame(api_routes)}, (lat, lon, distance, stop_distance)
+
+
+def route_positions(rng, number, geometry, vehicles=4, days=7, start='2020-03-02', interval=30, noise=8):
+    """Simulates the fixes of the vehicles of one route, shuttling between its terminals from 5:00 to 23:00."""
+
+    lat, lon, distance, stop_distance = geometry
+    length = distance[-1]
+    reverse_stops = np.sort(length - stop_distance)
+
+    midnight = (pd.Timestamp(start) - pd.Timestamp('1970-01-01')).total_seconds() - UTC_OFFSET
+
+    # Vehicles start one after the other, spread over a round trip at the scheduled speed.
+    round_trip = 2 * length / (18 / 3.6)
+
+    frames = []
+    for day in range(days):
+        weekend = (pd.Timestamp(start) + pd.Timedelta(days=day)).dayofweek >= 5
+        for vehicle in range(vehicles):
+            clock = midnight + day * 86400 + 5 * 3600 + vehicle * round_trip / vehicles
+            direction_id = vehicle % 2
+
+            while clock < midnight + day * 86400 + 23 * 3600:
+                fix_times, travelled, clock = trip_fixes(rng, stop_distance if direction_id == 0 else reverse_stops,
+                                                         length, clock, interval, weekend=weekend)
+                along = travelled if direction_id == 0 else length - travelled
+
+                frames.append(pd.DataFrame({'p': 10000 + number * 100 + vehicle,
+                                            'cl': 1000 + number + 32768 * direction_id, 'ta': fix_times,
+                                            'py': np.interp(along, distance, lat), 'px': np.interp(along, distance, lon)}))
+
+                # Lays over at the terminal and heads back.
+                clock += rng.uniform(120, 600)
+                direction_id = 1 - direction_id
+
+    positions = pd.concat(frames, ignore_index=True)
+
+    offset_y, offset_x = rng.normal(0, noise, (2, len(positions)))
+    positions['py'] += np.degrees(offset_y / linref.EARTH_RADIUS)
+    positions['px'] += np.degrees(offset_x / (linref.EARTH_RADIUS * np.cos(np.radians(CENTER[0]))))
+
+    seconds = positions['ta'].to_numpy().astype('int64').astype('datetime64[s]')
+    local = seconds + np.timedelta64(UTC_OFFSET, 's')
+
+    # ta is the UTC time of the fix and hr the local time of the API response, as the API reports them.
+    positions['ta'] = np.char.add(np.datetime_as_string(seconds, unit='s').astype(str), 'Z')
+    positions['hr'] = pd.Series(np.datetime_as_string(local, unit='m').astype(str), index=positions.index).str[-5:]
+    positions['c'] = f'{1000 + number}-10'
+    positions['lt0'] = 'Centro'
+    positions['lt1'] = f'Terminal {number}'
+    positions['qv'] = vehicles
+    positions['a'] = True
+
+    return positions[['hr', 'c', 'cl', 'lt0', 'lt1', 'qv', 'p', 'a', 'ta', 'py', 'px']]
+
+
+def passenger_counts(rng, route_names, start='2020-01-01', days=365):
+    """Daily passengers of every route, busier on weekdays and with a slow seasonal swing."""
+
+    dates = pd.date_range(start, periods=days)
+    weekday = np.where(dates.dayofweek < 5, 1.0, 0.55)
+    season = 1 + 0.1 * np.sin(2 * np.pi * dates.dayofyear / 365)
+
+    frames = []
+    for route_id, long_name in route_names:
+        base = rng.lognormal(8, 0.5)
+        frames.append(pd.DataFrame({'date': dates.strftime('%Y-%m-%d'), 'type': 'Ônibus', 'area': 'Centro',
+                                    'company': 'Viação Sintética', 'routes': f'{route_id} - {long_name}',
+                                    'name': long_name,
+                                    'passengers': np.round(base * weekday * season * rng.lognormal(0, 0.1, days))}))
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def _append(connection, table, frame, first_index):
+    frame = frame.copy()
+    frame.insert(0, 'index', np.arange(first_index, first_index + len(frame)))
+    schema.insert_rows(connection, table, frame)
+
+    return first_index + len(frame)
+
+
+def generate(connection, routes=10, vehicles=4, days=7, stops_per_route=30, passenger_days=365, interval=30, seed=0):
+    """Creates the source tables of bus.db in an empty database and fills them with a synthetic city.
+
+    The number of fixes grows with routes x vehicles x days; every vehicle reports about 2000 fixes a day at the
+    default 30 second interval.
+    """
+
+    rng = np.random.default_rng(seed)
+    now = time.time()
+
+    with connection.begin():
+        for statement in TABLES.values():
+            connection.execute(text(statement))
+
+        counts = dict.fromkeys(TABLES, 0)
+        names = []
+        for number in range(routes):
+            tables, geometry = route_tables(rng, number, stops_per_route)
+            for table, frame in tables.items():
+                counts[table] = _append(connection, table, frame, counts[table])
+
+            positions = route_positions(rng, number, geometry, vehicles, days, interval=interval)
+            positions['id'] = np.arange(counts['bus_position'], counts['bus_position'] + len(positions))
+            counts['bus_position'] = _append(connection, 'bus_position', positions, counts['bus_position'])
+
+            names.append((tables['routes']['route_id'].iloc[0], tables['routes']['route_long_name'].iloc[0]))
+
+        counts['passengers'] = _append(connection, 'passengers', passenger_counts(rng, names, days=passenger_days), 0)
+
+    print(', '.join(f'{count} {table}' for table, count in counts.items()) + f' in {time.time() - now:.1f}s')
+
+    return counts